@@ -1,8 +1,19 @@
+import random
 import re
+import threading
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from time import monotonic, sleep
 
 import requests
 from bs4 import BeautifulSoup
 
+from .breaker import CircuitBreaker
+from .cache import TTLCache
+from .pool import SessionPool
+from .scanner import Page, scan
+from .throttle import RateLimiter
+
 
 class RecoverableException(Exception):
     pass
@@ -16,6 +27,14 @@ class HTTPException(RecoverableException):
     pass
 
 
+class CircuitOpen(RecoverableException):
+    pass
+
+
+class DeadlineExceeded(HTTPException):
+    pass
+
+
 class UnknownPayload(Exception):
     def __init__(self, message, html, cf, ulss):
         super().__init__(message)
@@ -32,25 +51,189 @@ URL_SERVICE = URL_ULSS + "/azione/sceglisede/servizio/{}"
 URL_CHECK = URL_ULSS + "/azione/controllocf"
 
 
+def set_root(url):
+    # Point the agent to another portal, like the one in `fakeportal`
+    global URL_ROOT, URL_ULSS, URL_COHORT_CHOOSE, URL_COHORT_SELECT
+    global URL_SERVICE, URL_CHECK
+    URL_ROOT = url.rstrip("/")
+    URL_ULSS = URL_ROOT + "/ulss{}"
+    URL_COHORT_CHOOSE = URL_ULSS + "/azione/sceglicorte/"
+    URL_COHORT_SELECT = URL_ULSS + "/azione/controllocf/corte/{}"
+    URL_SERVICE = URL_ULSS + "/azione/sceglisede/servizio/{}"
+    URL_CHECK = URL_ULSS + "/azione/controllocf"
+
+
+CHECK_ERRORS = (HTTPException, ApplicationException, CircuitOpen, UnknownPayload)
+
+MESSAGE_APPLICATION_ERROR = (
+    "Attenzione si e verificato un problema si prega di riprovare"
+)
+
+sessions = SessionPool()
+
+# Requests per second and concurrent requests allowed for every ULSS portal,
+# use `limits` to tune a specific ULSS.
+limiter = RateLimiter(rate=10, burst=10, max_in_flight=4)
+
+# Skip checks for a ULSS while its portal is failing
+breaker = CircuitBreaker()
+
+# How many pages of the same check can be fetched concurrently
+MAX_FANOUT = 4
+
+# Connect and read timeouts for every request, in seconds
+TIMEOUT = (5, 20)
+# How many times to retry idempotent requests, waiting `BACKOFF * 2 ** attempt`
+# seconds (with some jitter) between attempts
+RETRIES = 2
+BACKOFF = 0.5
+# Give up on a check that takes longer than this, in seconds
+DEADLINE = 60
+
+# Location pages are the same for everyone in the same ULSS, so they can be
+# shared between checks. Set it to a `cache.TTLCache` to enable it.
+location_cache = None
+
+# The location pages found by the last check of a subscription, and the pages
+# leading to them. The next check goes straight to the location pages, and
+# walks the whole tree again only if that doesn't work. Set it to `None` to
+# always walk the whole tree.
+paths = TTLCache(ttl=6 * 60 * 60, maxsize=100_000)
+path_hits = Counter()
+path_hits_lock = threading.Lock()
+
+
 def check(ulss, fiscal_code, health_insurance_number):
+    # Don't bother checking if the portal of this ULSS is down
+    token = breaker.allow(ulss)
+    if not token:
+        raise CircuitOpen()
     try:
-        return _check(ulss, fiscal_code, health_insurance_number)
+        result = _check(ulss, fiscal_code, health_insurance_number)
     except requests.exceptions.RequestException:
+        breaker.failure(ulss, token)
         raise HTTPException()
+    except DeadlineExceeded:
+        # Out of time, maybe waiting for our own rate limiter: it says
+        # nothing about the portal
+        breaker.release(ulss, token)
+        raise
+    except (HTTPException, ApplicationException):
+        breaker.failure(ulss, token)
+        raise
+    except Exception:
+        # The portal is up, it's us not understanding it
+        breaker.success(ulss, token)
+        raise
+    breaker.success(ulss, token)
+    return result
+
+
+def check_many(subscriptions, max_concurrency=8):
+    # Check a batch of subscriptions (rows with `subscription_id`, `ulss_id`,
+    # `fiscal_code`, and `health_insurance_number`, like the ones returned by
+    # `db.subscription.select_stale`) using up to `max_concurrency` threads.
+    #
+    # Results are yielded as `(subscription_id, state, available, unavailable)`
+    # in completion order. A failing check doesn't stop the batch: `state` is
+    # the exception that was raised, and both locations are `None`.
+    subscriptions = iter(subscriptions)
+    pending = {}
+
+    def submit(executor):
+        # Don't drain the whole iterable upfront, it might be a DB cursor.
+        for s in subscriptions:
+            future = executor.submit(
+                check, s["ulss_id"], s["fiscal_code"], s["health_insurance_number"]
+            )
+            pending[future] = s["subscription_id"]
+            if len(pending) >= max_concurrency * 2:
+                break
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        try:
+            submit(executor)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    subscription_id = pending.pop(future)
+                    try:
+                        state, available, unavailable = future.result()
+                    except CHECK_ERRORS as e:
+                        yield subscription_id, e, None, None
+                    else:
+                        yield subscription_id, state, available, unavailable
+                submit(executor)
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+class Deadline:
+    def __init__(self, seconds=None, clock=monotonic):
+        self.clock = clock
+        self.at = None if seconds is None else clock() + seconds
+
+    def remaining(self):
+        if self.at is None:
+            return None
+        return self.at - self.clock()
+
+    def check(self):
+        remaining = self.remaining()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceeded()
+        return remaining
+
+    def timeout(self):
+        # The timeout for the next request, so it doesn't outlive the deadline
+        remaining = self.check()
+        connect, read = TIMEOUT
+        if remaining is None:
+            return connect, read
+        return min(connect, remaining), min(read, remaining)
 
 
 def _check(ulss, fiscal_code, health_insurance_number):
-    session = requests.Session()
+    deadline = Deadline(DEADLINE)
+    with sessions.session(ulss) as session:
+        return _check_with_session(
+            session, ulss, fiscal_code, health_insurance_number, deadline
+        )
+
+
+def get_cookie(session, ulss, deadline):
+    retry(lambda: get(session, ulss, URL_ULSS.format(ulss), deadline), deadline)
+
+
+def submit(session, ulss, fiscal_code, health_insurance_number, deadline=None):
+    deadline = deadline or Deadline()
     data = {"cod_fiscale": fiscal_code, "num_tessera": health_insurance_number}
+    fresh = not session.cookies
 
-    # Get cookie
-    session.get(URL_ULSS.format(ulss))
+    # Get cookie, only if we don't have one already
+    if fresh:
+        get_cookie(session, ulss, deadline)
 
     # Submit the form
-    r = session.post(URL_CHECK.format(ulss), data=data)
+    r = post(session, ulss, URL_CHECK.format(ulss), deadline, data=data)
+
+    # If the portal rejects the cookie we reused, get a new one and try again
+    if not fresh and (r.status_code != 200 or MESSAGE_APPLICATION_ERROR in r.text):
+        sessions.count("refreshed")
+        session.cookies.clear()
+        get_cookie(session, ulss, deadline)
+        r = post(session, ulss, URL_CHECK.format(ulss), deadline, data=data)
+
     if r.status_code != 200:
         raise HTTPException()
-    html = r.text
+    return r.text
+
+
+def _check_with_session(
+    session, ulss, fiscal_code, health_insurance_number, deadline=None
+):
+    html = submit(session, ulss, fiscal_code, health_insurance_number, deadline)
 
     # Ginepraio time!
     try:
@@ -59,173 +242,427 @@ def _check(ulss, fiscal_code, health_insurance_number):
         # Seems like ULSS 1 has a different "start" page, so we try to extract locations
         # directly from the html
         state = "maybe_eligible"
-        available, unavailable = locations(session, None, ulss, html=html)
+        available, unavailable = locations(
+            session, None, ulss, html=html, deadline=deadline
+        )
         if not available and not unavailable:
             raise e
         return state, available, unavailable
 
     # That's a horrible patch
     if state == "eligible" and url is None:
-        available, unavailable = locations(session, None, ulss, html=html)
+        available, unavailable = locations(
+            session, None, ulss, html=html, deadline=deadline
+        )
         if not available and not unavailable:
             raise UnknownPayload("Error understanding payload", html, fiscal_code, ulss)
         return state, available, unavailable
 
     if url is None:
         return state, None, None
-    else:
-        available, unavailable = locations(session, url, ulss)
-        return state, available, unavailable
 
-
-def locations(session, url, ulss, max_depth=5, html=None):
-    if max_depth == 0:
-        return None, None
-
-    if html is None:
-        r = session.post(url)
+    key = (ulss, fiscal_code, health_insurance_number)
+    path = paths.get(key) if paths is not None else None
+    if path and path[0] == url:
+        result = follow(session, ulss, url, path[1], deadline=deadline)
+        count_path("hit" if result else "stale")
+        if result:
+            available, unavailable = result
+            return state, available, unavailable
+        paths.delete(key)
+    elif paths is not None:
+        count_path("miss")
+
+    root = Node(url)
+    walk(session, ulss, [root], deadline=deadline)
+    found = find_paths(root)
+    available, unavailable = merge_locations(root)
+    # Without any location `follow` can't tell the pages from ones we don't
+    # understand, walking the tree costs the same
+    if paths is not None and found and (available or unavailable):
+        paths.set(key, (url, found))
+    return state, available, unavailable
+
+
+def count_path(key):
+    with path_hits_lock:
+        path_hits[key] += 1
+
+
+class Node:
+    __slots__ = ("url", "label", "html", "children", "result")
+
+    def __init__(self, url, label="", html=None):
+        self.url = url
+        self.label = label
+        self.html = html
+        self.children = None
+        self.result = None
+
+
+def get(session, ulss, url, deadline=None, **kwargs):
+    with limiter.request(ulss):
+        timeout = (deadline or Deadline()).timeout()
+        return session.get(url, timeout=timeout, **kwargs)
+
+
+def post(session, ulss, url, deadline=None, **kwargs):
+    with limiter.request(ulss):
+        timeout = (deadline or Deadline()).timeout()
+        return session.post(url, timeout=timeout, **kwargs)
+
+
+def retry(fn, deadline=None, retries=None):
+    # Call `fn`, and call it again if the portal doesn't answer or answers with
+    # an error. Only use it for requests that can be safely repeated.
+    retries = RETRIES if retries is None else retries
+    deadline = deadline or Deadline()
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except DeadlineExceeded:
+            raise
+        except (requests.exceptions.RequestException, HTTPException):
+            if attempt == retries:
+                raise
+            delay = BACKOFF * 2**attempt * random.uniform(0.5, 1.5)
+            remaining = deadline.remaining()
+            if remaining is not None and remaining <= delay:
+                raise
+            sleep(delay)
+
+
+def fetch(session, ulss, url, deadline=None):
+    def attempt():
+        r = post(session, ulss, url, deadline)
         if r.status_code != 200:
             raise HTTPException()
-        html = r.text
-
-    if url and "sceglisede" in url:
-        available, unavailable = extract_locations(html)
-    else:
-        available, unavailable = {}, {}
-        for url, label in extract_urls(html, ulss):
-            sub_available, sub_unavailable = locations(
-                session, url, ulss, max_depth=max_depth - 1
-            )
-            if sub_available:
-                available[label] = sub_available
-            if sub_unavailable:
-                unavailable[label] = sub_unavailable
-
-        # Yes this can be done better
-        available_keys = list(available.keys())
-        unavailable_keys = list(unavailable.keys())
-        if available_keys and available_keys[0] == "":
-            available = available[""]
-        if unavailable_keys and unavailable_keys[0] == "":
-            unavailable = unavailable[""]
+        return r.text
 
-    return available, unavailable
+    return retry(attempt, deadline)
 
 
-def start(html, cf, ulss):
-    # Check if the response is a redirect to step 2
-    matches = re.findall(r"act_step\(2,(\d+)", html.replace(" ", ""))
-    if len(matches) == 1:
-        return "eligible", URL_SERVICE.format(ulss, matches[0])
+def is_location_page(url):
+    return url and "sceglisede" in url
 
-    if html.replace(" ", "").startswith("<script>scegliserv("):
-        matches = re.findall(r"scegliserv\((\d+)\)", html.replace(" ", ""))
-        if len(matches) == 1:
-            return "eligible", URL_SERVICE.format(ulss, matches[0])
 
-    # Check if the user doesn't belong to the ULSS
-    if (
-        "codice fiscale inserito non risulta tra quelli registrati presso questa ULSS"
-        in html
-    ):
-        return "not_registered", None
-
-    if "Attenzione si e verificato un problema si prega di riprovare" in html:
-        raise ApplicationException()
-
-    if "Il numero tessera non risulta valido per il codice fiscale indicato" in html:
-        return "wrong_health_insurance_number", None
-
-    if (
-        "Per il codice fiscale inserito &egrave; gi&agrave; iniziato il percorso vaccinale"
-        in html
-    ):
-        return "already_vaccinated", None
-
-    if (
-        "Per il codice fiscale inserito &egrave; gi&agrave; registrata una prenotazione"
-        in html
-    ):
-        return "already_booked", None
+def locations(
+    session, url, ulss, max_depth=5, html=None, max_fanout=None, deadline=None
+):
+    root = Node(url, html=html)
+    walk(session, ulss, [root], max_depth, max_fanout, deadline)
+    return merge_locations(root)
 
-    # Check if the user MAY be eligible
-    if (
-        "Attenzione non appartieni alle categorie che attualmente possono prenotare"
-        in html
-        and "javascript:sceglicorte()" in html
-    ):
-        return "maybe_eligible", URL_COHORT_CHOOSE.format(ulss)
 
-    if (
-        "Attenzione non appartieni alle categorie che attualmente possono prenotare"
-        in html
-        and "act_step(1)" in html
-    ):
-        return "not_eligible", None
+def walk(session, ulss, level, max_depth=5, max_fanout=None, deadline=None):
+    # Walk the cohort/service tree one level at a time, fetching sibling pages
+    # concurrently (at most `max_fanout` at a time), so a check takes as long
+    # as the tree is deep, not as long as the tree is big.
+    # All requests go through the same session since the portal keeps track
+    # of the fiscal code we submitted server side.
+    if max_fanout is None:
+        max_fanout = MAX_FANOUT
+    executor = None
+    try:
+        for _ in range(max_depth):
+            if not level:
+                break
+            # Don't start a new level if we ran out of time
+            if deadline:
+                deadline.check()
+            if location_cache is not None:
+                for node in level:
+                    if node.html is None and is_location_page(node.url):
+                        node.result = location_cache.get((ulss, node.url))
+            to_fetch = [
+                node for node in level if node.html is None and node.result is None
+            ]
+            if len(to_fetch) == 1 or max_fanout == 1:
+                for node in to_fetch:
+                    node.html = fetch(session, ulss, node.url, deadline)
+            elif to_fetch:
+                if executor is None:
+                    executor = ThreadPoolExecutor(max_workers=max_fanout)
+                pages = executor.map(
+                    lambda node: fetch(session, ulss, node.url, deadline), to_fetch
+                )
+                for node, page in zip(to_fetch, pages):
+                    node.html = page
+
+            next_level = []
+            for node in level:
+                if node.result is not None:
+                    continue
+                if is_location_page(node.url):
+                    node.result = extract_locations(node.html)
+                    # Don't share pages we didn't understand
+                    if location_cache is not None and any(node.result):
+                        location_cache.set((ulss, node.url), node.result)
+                else:
+                    node.children = [
+                        Node(child_url, label)
+                        for child_url, label in extract_urls(node.html, ulss)
+                    ]
+                    next_level.extend(node.children)
+            level = next_level
+    finally:
+        # Wait for the requests still running before the session is used
+        # again (or goes back to the pool), and don't start the queued ones
+        if executor:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+def merge_locations(node):
+    if node.result is not None:
+        return node.result
+    # We didn't go that deep
+    if node.children is None:
+        return None, None
 
-    if "Selezionare un servizio" in html:
-        return "eligible", None
+    available, unavailable = {}, {}
+    for child in node.children:
+        sub_available, sub_unavailable = merge_locations(child)
+        if sub_available:
+            available[child.label] = sub_available
+        if sub_unavailable:
+            unavailable[child.label] = sub_unavailable
+
+    # Yes this can be done better
+    available_keys = list(available.keys())
+    unavailable_keys = list(unavailable.keys())
+    if available_keys and available_keys[0] == "":
+        available = available[""]
+    if unavailable_keys and unavailable_keys[0] == "":
+        unavailable = unavailable[""]
 
-    raise UnknownPayload("Error understanding payload", html, cf, ulss)
+    return available, unavailable
 
 
-def soupify(html):
-    return BeautifulSoup(html, "html.parser")
+def find_paths(node, path=()):
+    # The location pages below `node`, as the list of `(url, label)` steps
+    # leading to each of them
+    if node.children is None:
+        return [path] if path and node.result is not None else []
+    return [
+        found
+        for child in node.children
+        for found in find_paths(child, path + ((child.url, child.label),))
+    ]
+
+
+def follow(session, ulss, url, known, max_fanout=None, deadline=None):
+    # Rebuild the tree from the paths found by `find_paths`, fetching only the
+    # location pages. Return `None` if they don't look like ones: some of them
+    # can have no locations, but not all of them.
+    root = Node(url)
+    nodes = {(): root}
+    for path in known:
+        for i, (step_url, label) in enumerate(path, 1):
+            if path[:i] not in nodes:
+                parent = nodes[path[: i - 1]]
+                node = nodes[path[:i]] = Node(step_url, label)
+                parent.children = parent.children or []
+                parent.children.append(node)
+    level = [nodes[path] for path in known]
+    walk(session, ulss, level, 1, max_fanout, deadline)
+    if any(node.result is None for node in level):
+        return None
+    if not any(any(node.result) for node in level):
+        return None
+    return merge_locations(root)
+
+
+class Rule:
+    # A rule to classify the payload we get after submitting the form. A rule
+    # matches if all `markers` are in the payload, and if `match` (when given)
+    # returns a tuple instead of `None`. The items of the tuple are passed to
+    # `url` to build the URL of the next step.
+    __slots__ = ("name", "state", "markers", "match", "url", "error")
+
+    def __init__(self, name, state=None, markers=(), match=None, url=None, error=None):
+        self.name = name
+        self.state = state
+        self.markers = markers
+        self.match = match
+        self.url = url
+        self.error = error
+
+
+# Most payloads only call `act_step(1)`, look for a call to step 2 before
+# parsing the calls
+RE_STEP_2 = re.compile(r"act_step\s*\(\s*2\s*,")
+
+
+def match_step(page):
+    if not RE_STEP_2.search(page.html):
+        return None
+    matches = page.find("act_step", step="2")
+    if len(matches) == 1 and len(matches[0]) > 1:
+        return (matches[0][1],)
+
+
+def match_service(page):
+    name, args = page.redirect()
+    if name == "scegliserv" and args and len(page.find("scegliserv")) == 1:
+        return (args[0],)
+
+
+MESSAGE_NOT_ELIGIBLE = (
+    "Attenzione non appartieni alle categorie che attualmente possono prenotare"
+)
+
+# Rules are evaluated in order, the first one matching wins. To support a new
+# message from the portal, add a rule here. Rules with a `match` have the
+# name of the call they look for as a marker, so most payloads skip the
+# regular expressions with a substring lookup. Calls can have spaces around
+# the parentheses, so the markers stop at the name.
+RULES = [
+    # Check if the response is a redirect to step 2
+    Rule(
+        "redirect_step",
+        "eligible",
+        ["act_step"],
+        match=match_step,
+        url=lambda ulss, service: URL_SERVICE.format(ulss, service),
+    ),
+    Rule(
+        "redirect_service",
+        "eligible",
+        ["scegliserv"],
+        match=match_service,
+        url=lambda ulss, service: URL_SERVICE.format(ulss, service),
+    ),
+    # Check if the user doesn't belong to the ULSS
+    Rule(
+        "not_registered",
+        "not_registered",
+        [
+            "codice fiscale inserito non risulta tra quelli registrati presso questa ULSS"
+        ],
+    ),
+    Rule(
+        "application_error",
+        markers=[MESSAGE_APPLICATION_ERROR],
+        error=ApplicationException,
+    ),
+    Rule(
+        "wrong_health_insurance_number",
+        "wrong_health_insurance_number",
+        ["Il numero tessera non risulta valido per il codice fiscale indicato"],
+    ),
+    Rule(
+        "already_vaccinated",
+        "already_vaccinated",
+        [
+            "Per il codice fiscale inserito &egrave; gi&agrave; iniziato il percorso vaccinale"
+        ],
+    ),
+    Rule(
+        "already_booked",
+        "already_booked",
+        [
+            "Per il codice fiscale inserito &egrave; gi&agrave; registrata una prenotazione"
+        ],
+    ),
+    # Check if the user MAY be eligible
+    Rule(
+        "maybe_eligible",
+        "maybe_eligible",
+        [MESSAGE_NOT_ELIGIBLE, "javascript:sceglicorte()"],
+        url=lambda ulss: URL_COHORT_CHOOSE.format(ulss),
+    ),
+    Rule("not_eligible", "not_eligible", [MESSAGE_NOT_ELIGIBLE, "act_step(1)"]),
+    Rule("services", "eligible", ["Selezionare un servizio"]),
+]
+
+rule_hits = Counter()
+rule_hits_lock = threading.Lock()
+
+
+def classify(html, rules=None):
+    # Return the first rule matching `html` and the result of its `match`.
+    # It's cheaper than looking the payload up in the scanner cache, so the
+    # payload is not cached.
+    return _classify(Page(html), RULES if rules is None else rules)
+
+
+def _classify(page, rules):
+    html = page.html
+    for rule in rules:
+        for marker in rule.markers:
+            if marker not in html:
+                break
+        else:
+            result = rule.match(page) if rule.match else ()
+            if result is not None:
+                return rule, result
+    return None, None
 
 
-def extract_urls(html, ulss):
-    soup = soupify(html)
-    urls = []
+def start(html, cf, ulss):
+    rule, result = classify(html)
+    with rule_hits_lock:
+        rule_hits[rule.name if rule else "unknown"] += 1
 
-    if html.replace(" ", "").startswith("<script>scegliserv("):
-        matches = re.findall(r"scegliserv\((\d+)\)", html.replace(" ", ""))
-        if matches:
-            urls.append([URL_SERVICE.format(ulss, matches[0]), ""])
+    if rule is None:
+        raise UnknownPayload("Error understanding payload", html, cf, ulss)
+    if rule.error:
+        raise rule.error()
+    if rule.url is None:
+        return rule.state, None
+    return rule.state, rule.url(ulss, *result)
 
-    if html.replace(" ", "").startswith("<script>act_step(2,"):
-        matches = re.findall(r"act_step\(2,(\d+)\)", html.replace(" ", ""))
-        if matches:
-            urls.append([URL_SERVICE.format(ulss, matches[0]), ""])
 
-    for button in soup.find_all("button"):
-        onclick = button.attrs.get("onclick", "")
-        matches = re.findall(r"scegliserv\((\d+)\)", onclick.replace(" ", ""))
-        if matches:
-            urls.append([URL_SERVICE.format(ulss, matches[0]), button.text])
+def extract_urls(html, ulss):
+    # Only the ids are memoized, URLs depend on the ULSS and on `set_root`
+    templates = {"service": URL_SERVICE, "cohort": URL_COHORT_SELECT}
+    return [
+        [templates[kind].format(ulss, id), label]
+        for kind, id, label in scan(html).memo(("urls",), _extract_urls)
+    ]
 
-    for button in soup.find_all("button"):
-        onclick = button.attrs.get("onclick", "")
-        matches = re.findall(r"act_step\(2,(\d+)\)", onclick.replace(" ", ""))
-        if matches:
-            urls.append([URL_SERVICE.format(ulss, matches[0]), button.text])
 
-    for button in soup.find_all("button"):
-        onclick = button.attrs.get("onclick", "")
-        matches = re.findall(r"inviacf\((\d+)\)", onclick.replace(" ", ""))
-        if matches:
-            urls.append([URL_COHORT_SELECT.format(ulss, matches[0]), button.text])
+def _extract_urls(page):
+    urls = []
 
-    return urls
+    name, args = page.redirect()
+    if name == "scegliserv" and args:
+        urls.append(("service", args[0], ""))
+    if name == "act_step" and len(args) > 1 and args[0] == "2":
+        urls.append(("service", args[1], ""))
+
+    services, steps, cohorts = [], [], []
+    for button in page.buttons:
+        service = step = cohort = None
+        for call, args in button.calls:
+            if call == "scegliserv" and args:
+                service = service or args[0]
+            elif call == "act_step" and len(args) > 1 and args[0] == "2":
+                step = step or args[1]
+            elif call == "inviacf" and args:
+                cohort = cohort or args[0]
+        if service:
+            services.append(("service", service, button.text))
+        if step:
+            steps.append(("service", step, button.text))
+        if cohort:
+            cohorts.append(("cohort", cohort, button.text))
+
+    return urls + services + steps + cohorts
 
 
-def is_back_button(button):
-    onclick_attr = button.attrs.get("onclick", "")
-    class_attr = button.attrs.get("class", "")
-    return (
-        "act_step(1)" in onclick_attr
-        or "sceglicorte" in onclick_attr
-        or "btn-back" in class_attr
-    )
+def extract_locations(html):
+    available, unavailable = scan(html).memo(("locations",), _extract_locations)
+    return list(available), list(unavailable)
 
 
-def extract_locations(html):
-    soup = soupify(html)
+def _extract_locations(page):
     available = []
     unavailable = []
-    for button in soup.find_all("button"):
-        if is_back_button(button):
+    for button in page.buttons:
+        if button.is_back():
             continue
-        if "disabled" in button.attrs:
+        if button.disabled:
             unavailable.append(button.text.strip())
         else:
             available.append(button.text.strip())
@@ -0,0 +1,37 @@
+import tracemalloc
+from time import perf_counter, perf_counter_ns
+
+
+def measure(fn, number=1000):
+    # Return how many times per second `fn` can be called
+    start = perf_counter()
+    for _ in range(number):
+        fn()
+    return number / (perf_counter() - start)
+
+
+def timings(fn, number=1000):
+    # Return the duration of every call to `fn`, in nanoseconds
+    durations = []
+    for _ in range(number):
+        start = perf_counter_ns()
+        fn()
+        durations.append(perf_counter_ns() - start)
+    return durations
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def allocations(fn):
+    # Return the peak of memory allocated while calling `fn`, in bytes
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak - before
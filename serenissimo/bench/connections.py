@@ -0,0 +1,83 @@
+# Benchmark the DB overhead of a bot handler: read the user, then update it
+# in a transaction, like most handlers do.
+#
+#     python -m serenissimo.bench.connections
+#
+# `fresh` opens a connection for every block, as `db.connection()` and
+# `db.transaction()` used to do, `pooled` reuses the connection of the thread.
+
+import argparse
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
+from .. import db
+from . import percentile, timings
+
+# The previous implementation, kept here as a reference.
+
+
+@contextmanager
+def legacy_transaction(database):
+    c = db.connect(database)
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        yield c
+    except:
+        c.rollback()
+        raise
+    else:
+        c.commit()
+    finally:
+        c.close()
+
+
+@contextmanager
+def legacy_connection(database):
+    c = db.connect(database)
+    try:
+        yield c
+    finally:
+        c.close()
+
+
+def handler(database, connection, transaction):
+    def run():
+        with connection(database) as c:
+            user = db.user.by_telegram_id(c, "1234")
+        with transaction(database) as t:
+            db.user.update(t, user["id"], snooze_from=22, snooze_to=7)
+
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the DB connections.")
+    parser.add_argument("--number", type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database = str(Path(tmp) / "bench.sqlite")
+        with db.transaction(database) as t:
+            db.init(t)
+            db.init_data(t)
+            db.user.insert(t, "1234")
+
+        cases = {
+            "fresh": handler(database, legacy_connection, legacy_transaction),
+            "pooled": handler(database, db.connection, db.transaction),
+        }
+        for name, fn in cases.items():
+            # Warm up
+            fn()
+            durations = timings(fn, args.number)
+            print(
+                f"{name:<10}"
+                f"{percentile(durations, 50) / 1e3:>10.1f} µs p50"
+                f"{percentile(durations, 99) / 1e3:>10.1f} µs p99"
+            )
+        db.close(database)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+# Benchmark the query selecting the subscriptions to check, on a database with
+# many subscriptions where only a few of them are due.
+#
+#     python -m serenissimo.bench.db
+#     python -m serenissimo.bench.db --subscriptions 100000
+#
+# `legacy` is the view computing the due time of every subscription on the
+# fly, `next_check_at` is the range scan on the materialized column.
+
+import argparse
+import random
+import tempfile
+from pathlib import Path
+from time import time
+
+from .. import db
+from . import percentile, timings
+
+# The previous implementation, kept here as a reference.
+LEGACY = """
+DROP VIEW IF EXISTS view_stale_subscriptions_legacy;
+CREATE VIEW view_stale_subscriptions_legacy AS WITH const AS (
+  SELECT CAST(strftime('%s', 'now') AS INT) AS now_utc,
+    CAST(
+      strftime('%H', datetime('now', '+2 hours')) AS INT
+    ) AS hour_cest
+)
+SELECT user.id as user_id,
+  user.telegram_id,
+  subscription.id as subscription_id,
+  subscription.ulss_id,
+  subscription.fiscal_code,
+  subscription.health_insurance_number,
+  subscription.status_id,
+  subscription.last_check,
+  subscription.locations
+FROM const,
+  user
+  INNER JOIN subscription ON (user.id = subscription.user_id)
+  INNER JOIN status ON (status.id = subscription.status_id)
+WHERE status_id NOT IN ("already_booked", "already_vaccinated")
+  AND subscription.ulss_id IS NOT NULL
+  AND subscription.fiscal_code IS NOT NULL
+  AND subscription.health_insurance_number IS NOT NULL
+  AND subscription.last_check <= now_utc - status.update_interval
+  AND (
+    (
+      user.snooze_from IS NULL
+      OR user.snooze_to IS NULL
+    )
+    OR (
+      user.snooze_from >= user.snooze_to
+      AND (
+        hour_cest < user.snooze_from
+        AND hour_cest >= user.snooze_to
+      )
+      OR (
+        user.snooze_from < user.snooze_to
+        AND (
+          hour_cest < user.snooze_from
+          OR hour_cest >= user.snooze_to
+        )
+      )
+    )
+  )
+ORDER BY subscription.last_check ASC;
+"""
+
+QUERIES = {
+    "legacy": "SELECT * FROM view_stale_subscriptions_legacy",
+    "next_check_at": "SELECT * FROM view_stale_subscriptions",
+}
+
+STATUSES = [
+    "eligible",
+    "not_eligible",
+    "maybe_eligible",
+    "not_registered",
+    "already_booked",
+    "already_vaccinated",
+]
+
+
+def populate(c, subscriptions, due):
+    # Every user has two subscriptions, `due` of them are due for a check
+    now = int(time())
+    users = (subscriptions + 1) // 2
+    c.execute("BEGIN")
+    c.executemany(
+        "INSERT INTO user (id, telegram_id, snooze_from, snooze_to) VALUES (?, ?, ?, ?)",
+        (
+            (i, str(i), *((22, 7) if i % 10 == 0 else (None, None)))
+            for i in range(1, users + 1)
+        ),
+    )
+    c.executemany(
+        """INSERT INTO subscription (user_id, ulss_id, fiscal_code,
+            health_insurance_number, status_id, last_check)
+        VALUES (?, ?, ?, ?, ?, ?)""",
+        (
+            (
+                i // 2 + 1,
+                i % 9 + 1,
+                f"FC{i:014}",
+                f"{i:06}",
+                random.choice(STATUSES),
+                now - (7 * 24 * 60 * 60 if random.random() < due else 60),
+            )
+            for i in range(subscriptions)
+        ),
+    )
+    c.execute("COMMIT")
+
+
+def plan(c, query):
+    return [row["detail"] for row in c.execute("EXPLAIN QUERY PLAN " + query)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the stale query.")
+    parser.add_argument("--subscriptions", type=int, default=1_000_000)
+    parser.add_argument("--due", type=float, default=0.01)
+    parser.add_argument("--number", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database = str(Path(tmp) / "bench.sqlite")
+        with db.transaction(database) as c:
+            db.init(c)
+            db.init_data(c)
+            c.executescript(LEGACY)
+        with db.connection(database) as c:
+            populate(c, args.subscriptions, args.due)
+            for name, query in QUERIES.items():
+                rows = len(c.execute(query).fetchall())
+                durations = timings(lambda: c.execute(query).fetchall(), args.number)
+                print(
+                    f"{name:<16}{rows:>8} rows"
+                    f"{percentile(durations, 50) / 1e6:>10.1f} ms p50"
+                    f"{percentile(durations, 99) / 1e6:>10.1f} ms p99"
+                )
+                for detail in plan(c, query):
+                    print(f"    {detail}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+# Compare the single pass scanner used by `agent` with the BeautifulSoup
+# implementation it replaced, using the HTML snippets found in `tests/`.
+#
+#     python -m serenissimo.bench.extract
+
+import ast
+import re
+from pathlib import Path
+
+from bs4 import BeautifulSoup
+
+from .. import agent, scanner
+from . import measure
+
+TESTS = Path(__file__).resolve().parents[2] / "tests"
+
+
+def load_snippets(path=TESTS):
+    snippets = []
+    for filename in sorted(path.glob("*.py")):
+        tree = ast.parse(filename.read_text())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Constant) and isinstance(node.value, str):
+                if "<button" in node.value or "<script" in node.value:
+                    snippets.append(node.value)
+    return snippets
+
+
+# The previous implementation, kept here as a reference.
+
+
+def legacy_start(html, cf, ulss):
+    matches = re.findall(r"act_step\(2,(\d+)", html.replace(" ", ""))
+    if len(matches) == 1:
+        return "eligible", agent.URL_SERVICE.format(ulss, matches[0])
+
+    if html.replace(" ", "").startswith("<script>scegliserv("):
+        matches = re.findall(r"scegliserv\((\d+)\)", html.replace(" ", ""))
+        if len(matches) == 1:
+            return "eligible", agent.URL_SERVICE.format(ulss, matches[0])
+
+    if (
+        "codice fiscale inserito non risulta tra quelli registrati presso questa ULSS"
+        in html
+    ):
+        return "not_registered", None
+
+    if "Attenzione si e verificato un problema si prega di riprovare" in html:
+        raise agent.ApplicationException()
+
+    if "Il numero tessera non risulta valido per il codice fiscale indicato" in html:
+        return "wrong_health_insurance_number", None
+
+    if (
+        "Per il codice fiscale inserito &egrave; gi&agrave; iniziato il percorso vaccinale"
+        in html
+    ):
+        return "already_vaccinated", None
+
+    if (
+        "Per il codice fiscale inserito &egrave; gi&agrave; registrata una prenotazione"
+        in html
+    ):
+        return "already_booked", None
+
+    if (
+        "Attenzione non appartieni alle categorie che attualmente possono prenotare"
+        in html
+        and "javascript:sceglicorte()" in html
+    ):
+        return "maybe_eligible", agent.URL_COHORT_CHOOSE.format(ulss)
+
+    if (
+        "Attenzione non appartieni alle categorie che attualmente possono prenotare"
+        in html
+        and "act_step(1)" in html
+    ):
+        return "not_eligible", None
+
+    if "Selezionare un servizio" in html:
+        return "eligible", None
+
+    raise agent.UnknownPayload("Error understanding payload", html, cf, ulss)
+
+
+def legacy_extract_urls(html, ulss):
+    soup = BeautifulSoup(html, "html.parser")
+    urls = []
+
+    if html.replace(" ", "").startswith("<script>scegliserv("):
+        matches = re.findall(r"scegliserv\((\d+)\)", html.replace(" ", ""))
+        if matches:
+            urls.append([agent.URL_SERVICE.format(ulss, matches[0]), ""])
+
+    if html.replace(" ", "").startswith("<script>act_step(2,"):
+        matches = re.findall(r"act_step\(2,(\d+)\)", html.replace(" ", ""))
+        if matches:
+            urls.append([agent.URL_SERVICE.format(ulss, matches[0]), ""])
+
+    for button in soup.find_all("button"):
+        onclick = button.attrs.get("onclick", "")
+        matches = re.findall(r"scegliserv\((\d+)\)", onclick.replace(" ", ""))
+        if matches:
+            urls.append([agent.URL_SERVICE.format(ulss, matches[0]), button.text])
+
+    for button in soup.find_all("button"):
+        onclick = button.attrs.get("onclick", "")
+        matches = re.findall(r"act_step\(2,(\d+)\)", onclick.replace(" ", ""))
+        if matches:
+            urls.append([agent.URL_SERVICE.format(ulss, matches[0]), button.text])
+
+    for button in soup.find_all("button"):
+        onclick = button.attrs.get("onclick", "")
+        matches = re.findall(r"inviacf\((\d+)\)", onclick.replace(" ", ""))
+        if matches:
+            urls.append([agent.URL_COHORT_SELECT.format(ulss, matches[0]), button.text])
+
+    return urls
+
+
+def legacy_is_back_button(button):
+    onclick_attr = button.attrs.get("onclick", "")
+    class_attr = button.attrs.get("class", "")
+    return (
+        "act_step(1)" in onclick_attr
+        or "sceglicorte" in onclick_attr
+        or "btn-back" in class_attr
+    )
+
+
+def legacy_extract_locations(html):
+    soup = BeautifulSoup(html, "html.parser")
+    available = []
+    unavailable = []
+    for button in soup.find_all("button"):
+        if legacy_is_back_button(button):
+            continue
+        if "disabled" in button.attrs:
+            unavailable.append(button.text.strip())
+        else:
+            available.append(button.text.strip())
+    return available, unavailable
+
+
+def cold(fn):
+    # Don't let the scanner cache hide the parsing cost
+    def wrapper(*args):
+        scanner.clear()
+        return fn(*args)
+
+    return wrapper
+
+
+def safe(fn):
+    def wrapper(*args):
+        try:
+            return fn(*args)
+        except agent.UnknownPayload:
+            return None
+
+    return wrapper
+
+
+FUNCTIONS = [
+    ("start", safe(legacy_start), cold(safe(agent.start)), ("X", 0)),
+    ("extract_urls", legacy_extract_urls, cold(agent.extract_urls), (0,)),
+    ("extract_locations", legacy_extract_locations, cold(agent.extract_locations), ()),
+]
+
+
+def main(number=200):
+    snippets = load_snippets()
+    print(f"{len(snippets)} snippets from {TESTS}\n")
+    print(f"{'function':<20}{'before (ops/s)':>16}{'after (ops/s)':>16}{'speedup':>10}")
+    for name, before, after, args in FUNCTIONS:
+        for html in snippets:
+            if before(html, *args) != after(html, *args):
+                raise AssertionError(f"{name} returns a different result for {html!r}")
+
+        ops_before = measure(lambda: [before(html, *args) for html in snippets], number)
+        ops_after = measure(lambda: [after(html, *args) for html in snippets], number)
+        print(
+            f"{name:<20}{ops_before * len(snippets):>16.0f}"
+            f"{ops_after * len(snippets):>16.0f}{ops_after / ops_before:>9.1f}x"
+        )
+
+    # A check usually looks at the same payload twice, the second time the
+    # scanner cache kicks in.
+    def check_before(html):
+        safe(legacy_start)(html, "X", 0)
+        legacy_extract_urls(html, 0)
+
+    def check_after(html):
+        scanner.clear()
+        safe(agent.start)(html, "X", 0)
+        agent.extract_urls(html, 0)
+
+    ops_before = measure(lambda: [check_before(html) for html in snippets], number)
+    ops_after = measure(lambda: [check_after(html) for html in snippets], number)
+    print(
+        f"{'start+extract_urls':<20}{ops_before * len(snippets):>16.0f}"
+        f"{ops_after * len(snippets):>16.0f}{ops_after / ops_before:>9.1f}x"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+# Benchmark the functions parsing the portal payloads, over the recorded
+# payloads in `serenissimo/fixtures`.
+#
+#     python -m serenissimo.bench.parser           # compare with the baseline
+#     python -m serenissimo.bench.parser --save    # update the baseline
+#
+# Numbers depend on the machine, so update the baseline before working on
+# the parser, and compare after.
+
+import argparse
+import json
+from pathlib import Path
+
+import pkg_resources
+
+from .. import agent, scanner
+from . import allocations, percentile, timings
+
+BASELINE = Path(__file__).parent / "baseline.json"
+
+# Payloads we get after submitting the form, one per state
+START = [
+    "eligible",
+    "eligible_service",
+    "not_eligible",
+    "maybe_eligible",
+    "not_registered",
+    "already_vaccinated",
+    "already_booked",
+    "wrong_health_insurance_number",
+    "services",
+]
+# Payloads with links to other pages
+URLS = ["cohorts", "services", "eligible", "eligible_service"]
+LOCATIONS = ["locations"]
+
+
+def load_corpus():
+    names = set(START + URLS + LOCATIONS)
+    return {
+        name: pkg_resources.resource_string(
+            "serenissimo", f"fixtures/{name}.html"
+        ).decode("utf8")
+        for name in names
+    }
+
+
+def cold(fn):
+    # Every payload is new to the scanner, like during a real check
+    def wrapper(*args):
+        scanner.clear()
+        return fn(*args)
+
+    return wrapper
+
+
+def build_cases(corpus):
+    available, unavailable = agent.extract_locations(corpus["locations"])
+    cohorts = [label for _, label in agent.extract_urls(corpus["cohorts"], 0)]
+    tree = {cohort: {"Servizio": available} for cohort in cohorts}
+
+    return {
+        "start": [
+            (cold(agent.start), (corpus[name], "XXXXXXXXXXXXXXXX", 0)) for name in START
+        ],
+        "extract_urls": [
+            (cold(agent.extract_urls), (corpus[name], 0)) for name in URLS
+        ],
+        "extract_locations": [
+            (cold(agent.extract_locations), (corpus[name],)) for name in LOCATIONS
+        ],
+        # The portal sent the same payloads as last time
+        "recheck": [
+            (agent.start, (corpus[name], "XXXXXXXXXXXXXXXX", 0)) for name in START
+        ]
+        + [(agent.extract_urls, (corpus[name], 0)) for name in URLS]
+        + [(agent.extract_locations, (corpus[name],)) for name in LOCATIONS],
+        "format_locations": [
+            (agent.format_locations, (available,)),
+            (agent.format_locations, (unavailable,)),
+            (agent.format_locations, (tree,)),
+        ],
+    }
+
+
+def run(number):
+    results = {}
+    for name, cases in build_cases(load_corpus()).items():
+
+        def batch():
+            for fn, args in cases:
+                fn(*args)
+
+        # Warm up
+        batch()
+        durations = timings(batch, number)
+        total = sum(durations) / 1e9
+        results[name] = {
+            "ops": round(number * len(cases) / total),
+            "p50_us": round(percentile(durations, 50) / len(cases) / 1e3, 1),
+            "p99_us": round(percentile(durations, 99) / len(cases) / 1e3, 1),
+            "alloc_kb": round(allocations(batch) / len(cases) / 1024, 1),
+        }
+    return results
+
+
+def change(current, baseline, key):
+    if not baseline or not baseline.get(key):
+        return ""
+    delta = (current[key] - baseline[key]) / baseline[key] * 100
+    return f"{delta:+.0f}%"
+
+
+def report(results, baseline):
+    print(
+        f"{'function':<20}{'ops/s':>10}{'':>7}{'p50 µs':>10}{'':>7}"
+        f"{'p99 µs':>10}{'':>7}{'alloc KiB':>10}{'':>7}"
+    )
+    for name, current in results.items():
+        before = baseline.get(name)
+        print(
+            f"{name:<20}"
+            f"{current['ops']:>10.0f}{change(current, before, 'ops'):>7}"
+            f"{current['p50_us']:>10.1f}{change(current, before, 'p50_us'):>7}"
+            f"{current['p99_us']:>10.1f}{change(current, before, 'p99_us'):>7}"
+            f"{current['alloc_kb']:>10.1f}{change(current, before, 'alloc_kb'):>7}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the payload parser.")
+    parser.add_argument("--number", type=int, default=2000)
+    parser.add_argument("--baseline", type=Path, default=BASELINE)
+    parser.add_argument("--save", action="store_true", help="update the baseline")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline.exists():
+        baseline = json.loads(args.baseline.read_text())
+
+    results = run(args.number)
+    report(results, baseline)
+
+    if args.save:
+        args.baseline.write_text(json.dumps(results, indent=2) + "\n")
+        print(f"\nBaseline saved to {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+# Benchmark the row factories on the queries returning many rows.
+#
+#     python -m serenissimo.bench.rows
+#     python -m serenissimo.bench.rows --subscriptions 10000
+
+import argparse
+import sqlite3
+import tempfile
+from pathlib import Path
+
+from .. import db
+from . import allocations, percentile, timings
+from .db import populate
+
+ROW_FACTORIES = {"dict": db.dict_factory, "row": sqlite3.Row, "tuple": None}
+
+QUERIES = {
+    "select_stale": db.subscription.select_stale,
+    "select_active": db.user.select_active,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the row factories.")
+    parser.add_argument("--subscriptions", type=int, default=100_000)
+    parser.add_argument("--number", type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database = str(Path(tmp) / "bench.sqlite")
+        with db.transaction(database) as t:
+            db.init(t)
+            db.init_data(t)
+        with db.connection(database) as c:
+            # Everything is due
+            populate(c, args.subscriptions, due=1)
+
+        print(f"{'query':<16}{'rows':<8}{'count':>8}{'p50 ms':>10}{'alloc MiB':>12}")
+        for query, select in QUERIES.items():
+            for name, row_factory in ROW_FACTORIES.items():
+                with db.connection(database, row_factory=row_factory) as c:
+                    fetch = lambda: select(c).fetchall()
+                    count = len(fetch())
+                    durations = timings(fetch, args.number)
+                    peak = allocations(fetch)
+                print(
+                    f"{query:<16}{name:<8}{count:>8}"
+                    f"{percentile(durations, 50) / 1e6:>10.1f}"
+                    f"{peak / 2**20:>12.1f}"
+                )
+        db.close(database)
+
+
+if __name__ == "__main__":
+    main()
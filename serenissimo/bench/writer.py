@@ -0,0 +1,101 @@
+# Benchmark writing the results of the checks, one transaction per write as
+# the check loop used to do, against the batching writer.
+#
+#     python -m serenissimo.bench.writer
+#     python -m serenissimo.bench.writer --checks 5000 --threads 8
+
+import argparse
+import tempfile
+import threading
+from pathlib import Path
+from time import perf_counter
+
+from .. import db
+from ..writer import Writer
+
+
+def populate(database, checks):
+    with db.transaction(database) as t:
+        db.init(t)
+        db.init_data(t)
+        user_id = db.user.insert(t, "1")
+        return [
+            db.subscription.insert(
+                t,
+                user_id,
+                ulss_id=1,
+                fiscal_code=f"FC{i:014}",
+                health_insurance_number=f"{i:06}",
+            )
+            for i in range(checks)
+        ]
+
+
+def save(t, subscription_id):
+    db.subscription.update(
+        t, subscription_id, status_id="eligible", locations="[]", set_last_check=True
+    )
+
+
+def direct(database, subscription_id):
+    with db.transaction(database) as t:
+        save(t, subscription_id)
+    with db.transaction(database) as t:
+        db.log.insert(t, "notification", 1)
+
+
+def batched(writer, subscription_id):
+    writer.submit(save, subscription_id)
+    writer.submit(db.log.insert, "notification", 1)
+
+
+def run(ids, threads, check):
+    # Split the checks between `threads`, like the workers of the check loop
+    def work(chunk):
+        for subscription_id in chunk:
+            check(subscription_id)
+
+    workers = [
+        threading.Thread(target=work, args=(ids[i::threads],)) for i in range(threads)
+    ]
+    start = perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the batching writer.")
+    parser.add_argument("--checks", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--rows", type=int, default=100)
+    parser.add_argument("--delay", type=float, default=0.5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database = str(Path(tmp) / "bench.sqlite")
+        ids = populate(database, args.checks)
+
+        elapsed = run(ids, args.threads, lambda i: direct(database, i))
+        print(
+            f"{'direct':<10}{elapsed:>8.2f} s"
+            f"{args.checks / elapsed:>10.0f} checks/s"
+            f"{args.checks * 2:>8} transactions"
+        )
+
+        writer = Writer(args.rows, args.delay, database=database)
+        start = perf_counter()
+        run(ids, args.threads, lambda i: batched(writer, i))
+        writer.stop()
+        elapsed = perf_counter() - start
+        print(
+            f"{'batched':<10}{elapsed:>8.2f} s"
+            f"{args.checks / elapsed:>10.0f} checks/s"
+            f"{writer.stats()['batches']:>8} transactions"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import threading
+from collections import Counter, deque
+from time import monotonic
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class Circuit:
+    def __init__(self, window):
+        self.state = CLOSED
+        self.outcomes = deque(maxlen=window)
+        self.opened_at = None
+        self.probing = False
+        # Changes with the state, to tell the calls let through before
+        self.generation = 1
+
+
+class CircuitBreaker:
+    # Stop talking to a ULSS portal that is down.
+    #
+    # The circuit of a ULSS opens when, out of the last `window` checks (and at
+    # least `min_calls`), the ratio of failures is `failure_rate` or more.
+    # While open, checks are refused. After `cooldown` seconds the circuit is
+    # half open: a single check is let through as a probe, if it succeeds the
+    # circuit closes, otherwise it opens again.
+    #
+    # `allow` returns a token to pass to `success`, `failure`, or `release`
+    # (when the outcome says nothing about the portal). Outcomes of calls let
+    # through before the circuit changed state are ignored.
+
+    def __init__(
+        self, failure_rate=0.5, window=10, min_calls=5, cooldown=60, clock=monotonic
+    ):
+        self.failure_rate = failure_rate
+        self.window = window
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.circuits = {}
+        self.counter = Counter()
+
+    def circuit(self, ulss):
+        if ulss not in self.circuits:
+            self.circuits[ulss] = Circuit(self.window)
+        return self.circuits[ulss]
+
+    def allow(self, ulss):
+        with self.lock:
+            circuit = self.circuit(ulss)
+            if circuit.state == OPEN:
+                if self.clock() - circuit.opened_at < self.cooldown:
+                    self.counter["rejected"] += 1
+                    return False
+                circuit.state = HALF_OPEN
+                circuit.generation += 1
+            if circuit.state == HALF_OPEN:
+                if circuit.probing:
+                    self.counter["rejected"] += 1
+                    return False
+                circuit.probing = True
+                self.counter["probes"] += 1
+            return circuit.generation
+
+    def current(self, ulss, token):
+        # The circuit of `ulss`, if `token` is from its current state
+        circuit = self.circuit(ulss)
+        if token is not None and token != circuit.generation:
+            self.counter["stale"] += 1
+            return None
+        return circuit
+
+    def success(self, ulss, token=None):
+        with self.lock:
+            circuit = self.current(ulss, token)
+            if circuit is None:
+                return
+            if circuit.state == HALF_OPEN:
+                circuit.state = CLOSED
+                circuit.generation += 1
+                circuit.probing = False
+                circuit.outcomes.clear()
+                self.counter["closed"] += 1
+            circuit.outcomes.append(True)
+
+    def release(self, ulss, token=None):
+        # Let another probe through
+        with self.lock:
+            circuit = self.current(ulss, token)
+            if circuit is not None and circuit.state == HALF_OPEN:
+                circuit.probing = False
+
+    def failure(self, ulss, token=None):
+        with self.lock:
+            circuit = self.current(ulss, token)
+            if circuit is None:
+                return
+            circuit.outcomes.append(False)
+            if circuit.state == HALF_OPEN:
+                self.trip(circuit)
+            elif circuit.state == CLOSED and len(circuit.outcomes) >= self.min_calls:
+                failures = circuit.outcomes.count(False)
+                if failures / len(circuit.outcomes) >= self.failure_rate:
+                    self.trip(circuit)
+
+    def trip(self, circuit):
+        circuit.state = OPEN
+        circuit.generation += 1
+        circuit.probing = False
+        circuit.opened_at = self.clock()
+        self.counter["opened"] += 1
+
+    def state(self, ulss):
+        with self.lock:
+            return self.circuit(ulss).state
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counter)
+            stats["circuits"] = {
+                ulss: circuit.state for ulss, circuit in self.circuits.items()
+            }
+        return stats
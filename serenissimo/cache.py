@@ -0,0 +1,57 @@
+import threading
+from collections import Counter, OrderedDict
+from time import monotonic
+
+
+class TTLCache:
+    # A small thread safe cache. Entries expire after `ttl` seconds, and when
+    # the cache is full the least recently used entry is evicted.
+
+    def __init__(self, ttl=60, maxsize=1024, clock=monotonic):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+        self.counter = Counter()
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                self.counter["misses"] += 1
+                return default
+            expires, value = item
+            if expires <= self.clock():
+                del self.data[key]
+                self.counter["misses"] += 1
+                self.counter["expired"] += 1
+                return default
+            self.data.move_to_end(key)
+            self.counter["hits"] += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (self.clock() + self.ttl, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.counter["evicted"] += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counter)
+            stats["size"] = len(self.data)
+        return stats
@@ -1,4 +1,3 @@
-from time import sleep
 from serenissimo import agent, db
 
 SELECT_ALL_SUBSCRIPTIONS = """SELECT user.id as user_id,
@@ -20,17 +19,20 @@ WHERE status_id NOT IN ("already_booked", "already_vaccinated")
   AND subscription.health_insurance_number IS NOT NULL"""
 
 with db.connection() as c:
-    for s in c.execute(SELECT_ALL_SUBSCRIPTIONS):
-        ulss_id = s["ulss_id"]
-        fiscal_code = s["fiscal_code"]
-        health_insurance_number = s["health_insurance_number"]
-        status_id, available, unavailable = agent.check(
-            ulss_id, fiscal_code, health_insurance_number
-        )
-        print(f"{ulss_id} {fiscal_code} {health_insurance_number} {status_id}")
-        print("Available locations:")
-        print(agent.format_locations(available))
-        print("Unavailable locations:")
-        print(agent.format_locations(unavailable))
-        print()
-        sleep(0)
+    subscriptions = {
+        s["subscription_id"]: s for s in c.execute(SELECT_ALL_SUBSCRIPTIONS)
+    }
+
+for subscription_id, status_id, available, unavailable in agent.check_many(
+    subscriptions.values()
+):
+    s = subscriptions[subscription_id]
+    ulss_id = s["ulss_id"]
+    fiscal_code = s["fiscal_code"]
+    health_insurance_number = s["health_insurance_number"]
+    print(f"{ulss_id} {fiscal_code} {health_insurance_number} {status_id!r}")
+    print("Available locations:")
+    print(agent.format_locations(available))
+    print("Unavailable locations:")
+    print(agent.format_locations(unavailable))
+    print()
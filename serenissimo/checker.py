@@ -0,0 +1,39 @@
+# Check subscriptions without running the bot, sharing them with the other
+# checker processes using the same DB. Run as many as needed, on one or more
+# machines:
+#
+#     python -m serenissimo.checker
+#
+# Run the bot with `CHECK_MODE=lease` to have it check subscriptions too, or
+# with `CHECK_MODE=off` to leave checks to the checkers.
+
+import logging
+
+from . import agent, db
+from .cache import TTLCache
+from .lease import Leases
+from .main import CATCH_UP_WINDOW, CHECK_WORKERS, LOCATION_CACHE_TTL, check_loop, writer
+
+log = logging.getLogger()
+
+
+def main():
+    with db.transaction() as t:
+        db.init(t)
+        db.init_data(t)
+    if LOCATION_CACHE_TTL:
+        agent.location_cache = TTLCache(ttl=LOCATION_CACHE_TTL)
+    leases = Leases(batch=CHECK_WORKERS * 4, window=CATCH_UP_WINDOW)
+    log.info("Start checker %s", leases.owner)
+    try:
+        check_loop(leases)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer.stop()
+        # Let the others take over right away
+        leases.release_all()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,9 @@
 # https://docs.oracle.com/database/bdb181/html/bdb-sql/lockhandling.html
 
 import sqlite3
+import threading
 from contextlib import contextmanager
-from . import user, subscription, log, stats
+from . import user, subscription, log, stats, negative_cache, lease, check_interval
 import pkg_resources
 
 
@@ -20,31 +21,73 @@ def dict_factory(c, row):
     return d
 
 
+# Rows are dicts by default. On queries returning many rows, pass
+# `row_factory=sqlite3.Row` (built in C, supports `row["column"]` too) or
+# `row_factory=None` (plain tuples) to `connection()` or `transaction()`.
+
+
+# Every thread keeps its connections open, one per database, instead of
+# opening (and setting up) a new one for every transaction.
+local = threading.local()
+
+
+def pooled(database="db.sqlite") -> sqlite3.Connection:
+    connections = getattr(local, "connections", None)
+    if connections is None:
+        connections = local.connections = {}
+    c = connections.get(database)
+    if c is None:
+        c = connections[database] = connect(database)
+    return c
+
+
+def close(database=None):
+    # Close the connections of the current thread
+    connections = getattr(local, "connections", {})
+    for name in [database] if database else list(connections):
+        c = connections.pop(name, None)
+        if c:
+            c.close()
+
+
 @contextmanager
-def transaction(database="db.sqlite") -> sqlite3.Connection:
+def transaction(database="db.sqlite", row_factory=dict_factory) -> sqlite3.Connection:
     # We must issue a "BEGIN IMMEDIATE" explicitly when running in auto-commit mode.
-    c = connect(database)
-    c.execute("BEGIN IMMEDIATE")
+    # A transaction in another transaction of the same thread (they share the
+    # connection) runs in a savepoint, so it rolls back on its own.
+    c = pooled(database)
+    previous, c.row_factory = c.row_factory, row_factory
+    nested = c.in_transaction
+    began = False
     try:
+        c.execute("SAVEPOINT nested" if nested else "BEGIN IMMEDIATE")
+        began = True
         yield c
     except:
-        c.rollback()
+        if nested and began:
+            c.execute("ROLLBACK TO nested")
+            c.execute("RELEASE nested")
         raise
     else:
-        c.commit()
+        if nested:
+            c.execute("RELEASE nested")
+        else:
+            c.commit()
     finally:
-        c.close()
+        # Don't hand out a connection stuck in a transaction
+        if not nested and c.in_transaction:
+            c.rollback()
+        c.row_factory = previous
 
 
 @contextmanager
 def connection(database="db.sqlite", row_factory=dict_factory) -> sqlite3.Connection:
-    c = connect(database, row_factory=row_factory)
+    c = pooled(database)
+    previous, c.row_factory = c.row_factory, row_factory
     try:
         yield c
-    except:
-        raise
     finally:
-        c.close()
+        c.row_factory = previous
 
 
 total = 0
@@ -66,8 +109,7 @@ def connect(database="db.sqlite", row_factory=dict_factory) -> sqlite3.Connectio
     c = sqlite3.connect(database, isolation_level=None)
     c.execute("PRAGMA foreign_keys = ON")
     c.execute("PRAGMA journal_mode = wal")
-    if row_factory:
-        c.row_factory = dict_factory
+    c.row_factory = row_factory
     # c.set_trace_callback(tracer(i))
     return c
 
@@ -0,0 +1,45 @@
+def get(c, ulss_id, status_id):
+    select = "SELECT * FROM check_interval WHERE ulss_id = ? AND status_id = ?"
+    r = c.execute(select, (ulss_id, status_id))
+    return r.fetchone()
+
+
+def save(
+    c,
+    ulss_id,
+    status_id,
+    changes,
+    elapsed,
+    opened,
+    open_time,
+    observed_at,
+    update_interval,
+):
+    insert = """
+        INSERT INTO check_interval (ulss_id, status_id, changes, elapsed,
+            opened, open_time, observed_at, update_interval)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (ulss_id, status_id) DO UPDATE
+        SET changes = excluded.changes,
+            elapsed = excluded.elapsed,
+            opened = excluded.opened,
+            open_time = excluded.open_time,
+            observed_at = excluded.observed_at,
+            update_interval = excluded.update_interval"""
+    return c.execute(
+        insert,
+        (
+            ulss_id,
+            status_id,
+            changes,
+            elapsed,
+            opened,
+            open_time,
+            observed_at,
+            update_interval,
+        ),
+    )
+
+
+def select_all(c):
+    return c.execute("SELECT * FROM check_interval ORDER BY ulss_id, status_id")
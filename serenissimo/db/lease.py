@@ -0,0 +1,88 @@
+# Checker processes sharing the DB claim the subscriptions they check with a
+# lease, so no two of them check the same subscription at the same time. A
+# lease is held by `owner` until `expires_at` (seconds since the epoch), then
+# anyone can take it over. Claim leases in a `transaction()`, so checkers
+# don't select the same subscriptions in between.
+
+
+def placeholders(items):
+    return ", ".join("?" * len(items))
+
+
+def select_stale(c, now, limit=100, since=0, window=0):
+    # Like `subscription.select_stale`, skipping subscriptions leased by
+    # someone. Subscriptions due before `since` are spread over the `window`
+    # seconds after it, like `scheduler.catch_up` does.
+    select = """
+        SELECT view_stale_subscriptions.*
+        FROM view_stale_subscriptions
+            INNER JOIN subscription ON (subscription.id = subscription_id)
+            LEFT JOIN lease USING (subscription_id)
+        WHERE (lease.expires_at IS NULL OR lease.expires_at <= :now)
+            AND (
+                subscription.next_check_at >= :since
+                OR :since + (subscription.id * 2654435761 % 4294967296)
+                    * :window / 4294967296 <= :now
+            )
+        ORDER BY view_stale_subscriptions.last_check ASC, subscription_id ASC
+        LIMIT :limit"""
+    return c.execute(
+        select, {"now": now, "limit": limit, "since": since, "window": window}
+    )
+
+
+def claim(c, owner, subscription_ids, now, expires_at):
+    # Take the leases that are free, expired, or already ours, and return the
+    # ids of the subscriptions we got
+    subscription_ids = list(subscription_ids)
+    insert = """
+        INSERT INTO lease (subscription_id, owner, expires_at)
+        VALUES (:subscription_id, :owner, :expires_at)
+        ON CONFLICT (subscription_id) DO UPDATE
+        SET owner = excluded.owner, expires_at = excluded.expires_at
+        WHERE lease.owner = excluded.owner OR lease.expires_at <= :now"""
+    c.executemany(
+        insert,
+        (
+            {
+                "subscription_id": i,
+                "owner": owner,
+                "expires_at": expires_at,
+                "now": now,
+            }
+            for i in subscription_ids
+        ),
+    )
+    select = f"""
+        SELECT subscription_id
+        FROM lease
+        WHERE owner = ? AND expires_at = ?
+            AND subscription_id IN ({placeholders(subscription_ids)})"""
+    r = c.execute(select, [owner, expires_at] + subscription_ids)
+    return {row["subscription_id"] for row in r}
+
+
+def extend(c, owner, subscription_ids, expires_at):
+    # Move the expiry of our leases, return how many we still hold
+    subscription_ids = list(subscription_ids)
+    update = f"""
+        UPDATE lease
+        SET expires_at = ?
+        WHERE owner = ?
+            AND subscription_id IN ({placeholders(subscription_ids)})"""
+    return c.execute(update, [expires_at, owner] + subscription_ids).rowcount
+
+
+def release(c, owner, subscription_ids=None):
+    if subscription_ids is None:
+        return c.execute("DELETE FROM lease WHERE owner = ?", (owner,))
+    subscription_ids = list(subscription_ids)
+    delete = f"""
+        DELETE FROM lease
+        WHERE owner = ?
+            AND subscription_id IN ({placeholders(subscription_ids)})"""
+    return c.execute(delete, [owner] + subscription_ids)
+
+
+def delete_expired(c, now):
+    return c.execute("DELETE FROM lease WHERE expires_at <= ?", (now,))
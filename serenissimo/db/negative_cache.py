@@ -0,0 +1,48 @@
+from hashlib import sha256
+
+# Some states don't change, or change rarely, for the same ULSS, fiscal code,
+# and health insurance number. Trust them for this many seconds before asking
+# the portal again.
+TTL = {
+    "not_registered": 2 * 24 * 60 * 60,
+    "wrong_health_insurance_number": 14 * 24 * 60 * 60,
+    "already_booked": 14 * 24 * 60 * 60,
+    "already_vaccinated": 30 * 24 * 60 * 60,
+}
+
+
+def key(ulss_id, fiscal_code, health_insurance_number):
+    # Don't keep fiscal codes around in clear
+    data = f"{ulss_id}:{fiscal_code}:{health_insurance_number}"
+    return sha256(data.encode("utf8")).hexdigest()
+
+
+def get(c, ulss_id, fiscal_code, health_insurance_number):
+    select = """
+        SELECT status_id
+        FROM negative_cache
+        WHERE key = ?
+            AND expires_at > CAST(strftime('%s', 'now') AS INT)"""
+    r = c.execute(select, (key(ulss_id, fiscal_code, health_insurance_number),))
+    row = r.fetchone()
+    return row["status_id"] if row else None
+
+
+def update(c, ulss_id, fiscal_code, health_insurance_number, status_id):
+    # Remember `status_id` if it's a state we can trust, forget what we knew
+    # otherwise
+    k = key(ulss_id, fiscal_code, health_insurance_number)
+    ttl = TTL.get(status_id)
+    if ttl is None:
+        return c.execute("DELETE FROM negative_cache WHERE key = ?", (k,))
+    insert = """
+        INSERT OR REPLACE INTO negative_cache (key, status_id, expires_at)
+        VALUES (?, ?, CAST(strftime('%s', 'now') AS INT) + ?)"""
+    return c.execute(insert, (k, status_id, ttl))
+
+
+def delete_expired(c):
+    delete = """
+        DELETE FROM negative_cache
+        WHERE expires_at <= CAST(strftime('%s', 'now') AS INT)"""
+    return c.execute(delete)
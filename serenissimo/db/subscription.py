@@ -89,6 +89,42 @@ def by_id(c, subscription_id):
     return c.execute(select, (subscription_id,)).fetchone()
 
 
-def select_stale(c):
+def select_stale(c, subscription_ids=None):
     select = "SELECT * FROM view_stale_subscriptions"
-    return c.execute(select)
\ No newline at end of file
+    if subscription_ids is None:
+        return c.execute(select)
+    subscription_ids = list(subscription_ids)
+    placeholders = ", ".join("?" * len(subscription_ids))
+    select += f" WHERE subscription_id IN ({placeholders})"
+    return c.execute(select, subscription_ids)
+
+
+def select_snooze_end(c, subscription_ids):
+    # When the users of the subscriptions stop snoozing
+    subscription_ids = list(subscription_ids)
+    placeholders = ", ".join("?" * len(subscription_ids))
+    select = f"""
+        SELECT subscription.id AS subscription_id,
+            user.snooze_end_at
+        FROM subscription
+            INNER JOIN user ON (user.id = subscription.user_id)
+        WHERE subscription.id IN ({placeholders})"""
+    return c.execute(select, subscription_ids)
+
+
+def select_next_check(c, subscription_ids=None):
+    # When subscriptions that can be checked are due for their next check
+    select = """
+        SELECT subscription.id AS subscription_id,
+            subscription.next_check_at AS next_check
+        FROM subscription
+        WHERE status_id NOT IN ("already_booked", "already_vaccinated")
+            AND subscription.ulss_id IS NOT NULL
+            AND subscription.fiscal_code IS NOT NULL
+            AND subscription.health_insurance_number IS NOT NULL"""
+    if subscription_ids is None:
+        return c.execute(select)
+    subscription_ids = list(subscription_ids)
+    placeholders = ", ".join("?" * len(subscription_ids))
+    select += f" AND subscription.id IN ({placeholders})"
+    return c.execute(select, subscription_ids)
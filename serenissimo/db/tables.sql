@@ -4,9 +4,13 @@ CREATE TABLE IF NOT EXISTS user (
   ts DATETIME DEFAULT (CAST(strftime('%s', 'now') AS INT)),
   last_message DATETIME,
   snooze_from INTEGER,
-  snooze_to INTEGER
+  snooze_to INTEGER,
+  -- The snooze window going on, or the next one, in seconds since the epoch
+  snooze_start_at INTEGER NULL,
+  snooze_end_at INTEGER NULL
 );
 CREATE UNIQUE INDEX IF NOT EXISTS idx_user_telegram_id ON user(telegram_id);
+CREATE INDEX IF NOT EXISTS idx_user_snooze_end_at ON user(snooze_end_at);
 CREATE TABLE IF NOT EXISTS subscription (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   user_id INTEGER,
@@ -16,6 +20,7 @@ CREATE TABLE IF NOT EXISTS subscription (
   health_insurance_number TEXT NULL,
   locations TEXT NOT NULL DEFAULT 'null',
   last_check DATETIME DEFAULT 0,
+  next_check_at INTEGER NOT NULL DEFAULT 0,
   ts DATETIME DEFAULT (CAST(strftime('%s', 'now') AS INT)),
   FOREIGN KEY (user_id) REFERENCES user (id) ON DELETE CASCADE,
   FOREIGN KEY (ulss_id) REFERENCES ulss (id),
@@ -23,6 +28,7 @@ CREATE TABLE IF NOT EXISTS subscription (
 );
 CREATE INDEX IF NOT EXISTS idx_subscription_status_id ON subscription(status_id);
 CREATE INDEX IF NOT EXISTS idx_subscription_last_check ON subscription(last_check);
+CREATE INDEX IF NOT EXISTS idx_subscription_next_check_at ON subscription(next_check_at, status_id);
 CREATE TABLE IF NOT EXISTS ulss (
   id INTEGER NOT NULL PRIMARY KEY,
   name TEXT NOT NULL
@@ -39,16 +45,91 @@ CREATE TABLE IF NOT EXISTS log (
   ts DATETIME DEFAULT (CAST(strftime('%s', 'now') AS INT))
 );
 CREATE INDEX IF NOT EXISTS idx_log_name ON log(name);
+CREATE TABLE IF NOT EXISTS negative_cache (
+  key TEXT NOT NULL PRIMARY KEY,
+  status_id TEXT NOT NULL,
+  expires_at INTEGER NOT NULL,
+  FOREIGN KEY (status_id) REFERENCES status (id)
+);
+CREATE TABLE IF NOT EXISTS lease (
+  subscription_id INTEGER NOT NULL PRIMARY KEY,
+  owner TEXT NOT NULL,
+  expires_at INTEGER NOT NULL,
+  FOREIGN KEY (subscription_id) REFERENCES subscription (id) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS idx_lease_owner ON lease(owner);
+-- How often locations change for subscriptions of a ULSS in a state, with
+-- the observations decayed over time, and the update interval we derived.
+CREATE TABLE IF NOT EXISTS check_interval (
+  ulss_id INTEGER NOT NULL,
+  status_id TEXT NOT NULL,
+  changes REAL NOT NULL DEFAULT 0,
+  elapsed REAL NOT NULL DEFAULT 0,
+  opened REAL NOT NULL DEFAULT 0,
+  open_time REAL NOT NULL DEFAULT 0,
+  observed_at INTEGER NOT NULL DEFAULT 0,
+  update_interval INTEGER NULL,
+  PRIMARY KEY (ulss_id, status_id),
+  FOREIGN KEY (ulss_id) REFERENCES ulss (id),
+  FOREIGN KEY (status_id) REFERENCES status (id)
+);
 --
 --
 -- Views
 --
+-- When a subscription is due for its next check: `status.update_interval`
+-- seconds after the last one (or the interval adapted for its ULSS), or when
+-- the snooze window of the user ends if that falls into it (see
+-- `db.user.snooze_window`).
+--
+-- Every subscription has a stable phase within its interval, from a hash of
+-- its id, and is due at the last time in that phase within the interval
+-- after the last check. Subscriptions checked at the same time, like after an
+-- outage, are spread over the interval from the next check on. Users waking
+-- up from a snooze are spread over the first 15 minutes after it (like
+-- `due.CATCH_UP_WINDOW`).
+DROP VIEW IF EXISTS view_next_check;
+CREATE VIEW IF NOT EXISTS view_next_check AS
+SELECT subscription_id,
+  CASE
+    WHEN due >= snooze_start_at
+    AND due < snooze_end_at THEN snooze_end_at + hash * 15 * 60 / 4294967296
+    ELSE due
+  END AS next_check_at
+FROM (
+    SELECT subscription_id,
+      hash,
+      snooze_start_at,
+      snooze_end_at,
+      -- Move back by less than an interval to get in phase
+      last_check + interval - (
+        (
+          last_check + interval - hash * interval / 4294967296
+        ) % interval + interval
+      ) % interval AS due
+    FROM (
+        SELECT subscription.id AS subscription_id,
+          subscription.last_check,
+          coalesce(
+            check_interval.update_interval,
+            status.update_interval
+          ) AS interval,
+          -- Knuth's multiplicative hash, see `scheduler.phase`
+          subscription.id * 2654435761 % 4294967296 AS hash,
+          user.snooze_start_at,
+          user.snooze_end_at
+        FROM subscription
+          INNER JOIN status ON (status.id = subscription.status_id)
+          INNER JOIN user ON (user.id = subscription.user_id)
+          LEFT JOIN check_interval ON (
+            check_interval.ulss_id = subscription.ulss_id
+            AND check_interval.status_id = subscription.status_id
+          )
+      )
+  );
 DROP VIEW IF EXISTS view_stale_subscriptions;
 CREATE VIEW IF NOT EXISTS view_stale_subscriptions AS WITH const AS (
-  SELECT CAST(strftime('%s', 'now') AS INT) AS now_utc,
-    CAST(
-      strftime('%H', datetime('now', '+2 hours')) AS INT
-    ) AS hour_cest
+  SELECT CAST(strftime('%s', 'now') AS INT) AS now_utc
 )
 SELECT user.id as user_id,
   user.telegram_id,
@@ -62,31 +143,99 @@ SELECT user.id as user_id,
 FROM const,
   user
   INNER JOIN subscription ON (user.id = subscription.user_id)
-  INNER JOIN status ON (status.id = subscription.status_id)
-WHERE status_id NOT IN ("already_booked", "already_vaccinated")
+WHERE subscription.next_check_at <= now_utc
+  AND status_id NOT IN ("already_booked", "already_vaccinated")
   AND subscription.ulss_id IS NOT NULL
   AND subscription.fiscal_code IS NOT NULL
   AND subscription.health_insurance_number IS NOT NULL
-  AND subscription.last_check <= now_utc - status.update_interval
   AND (
-    (
-      -- If one or both values are NULL, check.
-      user.snooze_from IS NULL
-      OR user.snooze_to IS NULL
-    )
-    OR (
-      user.snooze_from >= user.snooze_to
-      AND (
-        hour_cest < user.snooze_from
-        AND hour_cest >= user.snooze_to
-      )
-      OR (
-        user.snooze_from < user.snooze_to
-        AND (
-          hour_cest < user.snooze_from
-          OR hour_cest >= user.snooze_to
-        )
-      )
-    )
+    -- If the user doesn't snooze, check.
+    user.snooze_end_at IS NULL
+    OR now_utc < user.snooze_start_at
+    OR now_utc >= user.snooze_end_at
+  )
+ORDER BY subscription.last_check ASC;
+--
+--
+-- Triggers
+--
+-- Keep `subscription.next_check_at` up to date
+DROP TRIGGER IF EXISTS trigger_subscription_insert_next_check_at;
+CREATE TRIGGER trigger_subscription_insert_next_check_at
+AFTER
+INSERT ON subscription BEGIN
+UPDATE subscription
+SET next_check_at = (
+    SELECT next_check_at
+    FROM view_next_check
+    WHERE subscription_id = NEW.id
+  )
+WHERE id = NEW.id;
+END;
+DROP TRIGGER IF EXISTS trigger_subscription_update_next_check_at;
+CREATE TRIGGER trigger_subscription_update_next_check_at
+AFTER
+UPDATE OF last_check,
+  status_id,
+  ulss_id ON subscription BEGIN
+UPDATE subscription
+SET next_check_at = (
+    SELECT next_check_at
+    FROM view_next_check
+    WHERE subscription_id = NEW.id
+  )
+WHERE id = NEW.id;
+END;
+DROP TRIGGER IF EXISTS trigger_user_snooze_next_check_at;
+CREATE TRIGGER trigger_user_snooze_next_check_at
+AFTER
+UPDATE OF snooze_start_at,
+  snooze_end_at ON user BEGIN
+UPDATE subscription
+SET next_check_at = (
+    SELECT next_check_at
+    FROM view_next_check
+    WHERE subscription_id = subscription.id
+  )
+WHERE user_id = NEW.id;
+END;
+DROP TRIGGER IF EXISTS trigger_status_next_check_at;
+CREATE TRIGGER trigger_status_next_check_at
+AFTER
+UPDATE OF update_interval ON status BEGIN
+UPDATE subscription
+SET next_check_at = (
+    SELECT next_check_at
+    FROM view_next_check
+    WHERE subscription_id = subscription.id
+  )
+WHERE status_id = NEW.id;
+END;
+DROP TRIGGER IF EXISTS trigger_check_interval_insert_next_check_at;
+CREATE TRIGGER trigger_check_interval_insert_next_check_at
+AFTER
+INSERT ON check_interval
+  WHEN NEW.update_interval IS NOT NULL BEGIN
+UPDATE subscription
+SET next_check_at = (
+    SELECT next_check_at
+    FROM view_next_check
+    WHERE subscription_id = subscription.id
+  )
+WHERE ulss_id = NEW.ulss_id
+  AND status_id = NEW.status_id;
+END;
+DROP TRIGGER IF EXISTS trigger_check_interval_update_next_check_at;
+CREATE TRIGGER trigger_check_interval_update_next_check_at
+AFTER
+UPDATE OF update_interval ON check_interval
+  WHEN NEW.update_interval IS NOT OLD.update_interval BEGIN
+UPDATE subscription
+SET next_check_at = (
+    SELECT next_check_at
+    FROM view_next_check
+    WHERE subscription_id = subscription.id
   )
-ORDER BY subscription.last_check ASC;
\ No newline at end of file
+WHERE ulss_id = NEW.ulss_id
+  AND status_id = NEW.status_id;
+END;
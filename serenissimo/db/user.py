@@ -1,5 +1,15 @@
+from datetime import datetime, timedelta
+from time import time
+from zoneinfo import ZoneInfo
+
 from .common import select_last_id
 
+# Snooze hours are in the time of the users
+TIMEZONE = ZoneInfo("Europe/Rome")
+# Compile the next window only a while after the current one ended, so the
+# subscriptions waking up keep their spread (see `view_next_check`)
+SNOOZE_ROLL_DELAY = 15 * 60
+
 
 def by_id(c, id):
     select = "SELECT * FROM user WHERE id = ?"
@@ -19,7 +29,71 @@ def insert(c, telegram_id):
     return select_last_id(c)
 
 
-def update(c, id, snooze_from=None, snooze_to=None):
+def snooze_window(snooze_from, snooze_to, now):
+    # The snooze window going on at `now`, or the next one, as seconds since
+    # the epoch. `snooze_from` and `snooze_to` are hours of the day, 24 is
+    # midnight, and the window goes over midnight if it ends before it starts.
+    if snooze_from is None or snooze_to is None:
+        return None
+    today = datetime.fromtimestamp(now, TIMEZONE).date()
+    for days in (-1, 0, 1):
+        day = today + timedelta(days=days)
+        start = at_hour(day, snooze_from)
+        end = at_hour(day, snooze_to)
+        if end <= start:
+            end = at_hour(day + timedelta(days=1), snooze_to)
+        if end > now:
+            return start, end
+
+
+def at_hour(day, hour):
+    # Hours are wall clock time, so days are 23 or 25 hours long when DST
+    # starts or ends
+    day += timedelta(days=hour // 24)
+    local = datetime(day.year, day.month, day.day, hour % 24, tzinfo=TIMEZONE)
+    return int(local.timestamp())
+
+
+def compile_snooze(c, id, now):
+    snooze = c.execute(
+        "SELECT snooze_from, snooze_to FROM user WHERE id = ?", (id,)
+    ).fetchone()
+    if snooze is None:
+        return
+    window = snooze_window(snooze["snooze_from"], snooze["snooze_to"], now)
+    start, end = window or (None, None)
+    update = """
+        UPDATE
+            user
+        SET
+            snooze_start_at = :start,
+            snooze_end_at = :end
+        WHERE
+            id = :id"""
+    return c.execute(update, {"id": id, "start": start, "end": end})
+
+
+def roll_snooze(c, now):
+    # Compile the next window of the users whose window ended
+    select = """
+        SELECT id
+        FROM user
+        WHERE snooze_end_at <= :ended
+            OR (
+                snooze_end_at IS NULL
+                AND snooze_from IS NOT NULL
+                AND snooze_to IS NOT NULL
+            )"""
+    ids = [
+        row["id"]
+        for row in c.execute(select, {"ended": now - SNOOZE_ROLL_DELAY}).fetchall()
+    ]
+    for id in ids:
+        compile_snooze(c, id, now)
+    return len(ids)
+
+
+def update(c, id, snooze_from=None, snooze_to=None, now=None):
     update = """
         UPDATE
             user
@@ -28,7 +102,7 @@ def update(c, id, snooze_from=None, snooze_to=None):
             snooze_to = coalesce(:snooze_to, snooze_to)
         WHERE
             id = :id"""
-    return c.execute(
+    c.execute(
         update,
         {
             "id": id,
@@ -36,6 +110,7 @@ def update(c, id, snooze_from=None, snooze_to=None):
             "snooze_to": snooze_to,
         },
     )
+    return compile_snooze(c, id, time() if now is None else now)
 
 
 def reset_snooze(c, id):
@@ -44,7 +119,9 @@ def reset_snooze(c, id):
             user
         SET
             snooze_from = NULL,
-            snooze_to = NULL
+            snooze_to = NULL,
+            snooze_start_at = NULL,
+            snooze_end_at = NULL
         WHERE
             id = :id"""
     return c.execute(
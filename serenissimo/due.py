@@ -0,0 +1,100 @@
+# When every subscription is due for its next check, kept in memory so the
+# check loop doesn't have to ask the DB every minute. Load it with `load()`
+# at startup, and `reschedule` subscriptions when they're created, checked,
+# or snoozed. Deleted subscriptions are dropped when they get due.
+# Until it's loaded nothing pops the queue (e.g. checks run with leases, or
+# elsewhere), so `reschedule` and friends do nothing.
+
+import sqlite3
+from time import time
+
+from . import db
+from .scheduler import DueQueue, catch_up
+
+queue = DueQueue()
+loaded = False
+
+# Spread the subscriptions already due at startup, or waking up at the end of
+# a snooze window, over this many seconds
+CATCH_UP_WINDOW = 15 * 60
+
+
+def chunks(items, size=500):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def load(database="db.sqlite", window=CATCH_UP_WINDOW):
+    global loaded
+    # Before reading the DB, not to miss what's rescheduled meanwhile
+    loaded = True
+    now = time()
+    with db.connection(database, row_factory=None) as c:
+        for subscription_id, next_check in db.subscription.select_next_check(c):
+            queue.schedule(
+                subscription_id, catch_up(subscription_id, next_check, now, window)
+            )
+    return len(queue)
+
+
+def reschedule(subscription_ids, retry_at=None, spread=0, database="db.sqlite"):
+    # Subscriptions already due are scheduled at `retry_at`, if given, spread
+    # over the `spread` seconds after it
+    if not loaded:
+        return
+    now = time()
+    subscription_ids = set(subscription_ids)
+    with db.connection(database, row_factory=None) as c:
+        for chunk in chunks(subscription_ids):
+            for subscription_id, at in db.subscription.select_next_check(c, chunk):
+                subscription_ids.discard(subscription_id)
+                if at <= now and retry_at:
+                    at = catch_up(subscription_id, 0, retry_at, spread)
+                queue.schedule(subscription_id, at)
+    # Not there, or not to be checked anymore
+    for subscription_id in subscription_ids:
+        queue.remove(subscription_id)
+
+
+def reschedule_user(user_id, database="db.sqlite"):
+    if not loaded:
+        return
+    with db.connection(database) as c:
+        subscriptions = db.subscription.by_user(c, user_id).fetchall()
+    reschedule([s["id"] for s in subscriptions], database=database)
+
+
+def remove_user(c, user_id):
+    # Call it before deleting the user
+    if not loaded:
+        return
+    for s in db.subscription.by_user(c, user_id):
+        queue.remove(s["id"])
+
+
+def select_due(database="db.sqlite", window=CATCH_UP_WINDOW):
+    # The subscriptions due for a check, as rows of `select_stale`
+    now = time()
+    subscription_ids = queue.pop(now)
+    subscriptions = []
+    with db.connection(database, row_factory=sqlite3.Row) as c:
+        for chunk in chunks(subscription_ids):
+            subscriptions.extend(db.subscription.select_stale(c, chunk))
+    subscriptions.sort(key=lambda s: s["last_check"])
+
+    # The ones left are snoozed, look at them again when the snooze window
+    # ends, or gone
+    found = {s["subscription_id"] for s in subscriptions}
+    left = [i for i in subscription_ids if i not in found]
+    gone = set(left)
+    with db.connection(database, row_factory=None) as c:
+        for chunk in chunks(left):
+            for subscription_id, end in db.subscription.select_snooze_end(c, chunk):
+                if end and end > now:
+                    gone.discard(subscription_id)
+                    queue.schedule(
+                        subscription_id, catch_up(subscription_id, 0, end, window)
+                    )
+    reschedule(gone, retry_at=now, spread=window, database=database)
+    return subscriptions
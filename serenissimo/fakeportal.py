@@ -0,0 +1,228 @@
+# A local stand-in for https://vaccinicovid.regione.veneto.it, serving the
+# same routes as the real portal with the HTML in `serenissimo/fixtures`.
+# Use it to measure and test the checker without hitting the real thing:
+#
+#     python -m serenissimo.fakeportal --port 8000 --latency 0.1 --error-rate 0.01
+#
+# and then point the agent to it with `agent.set_root("http://localhost:8000")`.
+#
+# The behavior of every ULSS can be configured. The keys are:
+#
+# - `start`: the fixture returned after submitting the form.
+# - `fiscal_codes`: maps a fiscal code to a `start` fixture, for that user only.
+# - `cohorts`, `services`, `locations`: the fixtures for the cohort list, the
+#   service list, and the location list.
+# - `latency`: how many seconds to wait before answering.
+# - `error_rate`: the probability to answer with a 500.
+
+import argparse
+import json
+import random
+import re
+import threading
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+from urllib.parse import parse_qs
+
+import pkg_resources
+
+DEFAULT_BEHAVIOR = {
+    "start": "maybe_eligible",
+    "fiscal_codes": {},
+    "cohorts": "cohorts",
+    "services": "services",
+    "locations": "locations",
+    "latency": 0,
+    "error_rate": 0,
+}
+
+ROUTES = [
+    ("GET", re.compile(r"^/ulss(\d+)/?$"), "home"),
+    ("POST", re.compile(r"^/ulss(\d+)/azione/controllocf/?$"), "start"),
+    ("POST", re.compile(r"^/ulss(\d+)/azione/sceglicorte/?$"), "cohorts"),
+    ("POST", re.compile(r"^/ulss(\d+)/azione/controllocf/corte/(\d+)$"), "services"),
+    (
+        "POST",
+        re.compile(r"^/ulss(\d+)/azione/sceglisede/servizio/(\d+)$"),
+        "locations",
+    ),
+]
+
+COOKIE = "PHPSESSID"
+
+
+def load_fixture(name):
+    return pkg_resources.resource_string(__name__, f"fixtures/{name}.html").decode(
+        "utf8"
+    )
+
+
+class FakePortal:
+    def __init__(self, host="127.0.0.1", port=0, behavior=None, seed=None, **default):
+        self.default = dict(DEFAULT_BEHAVIOR, **default)
+        self.behavior = {int(k): v for k, v in (behavior or {}).items()}
+        self.random = random.Random(seed)
+        self.fixtures = {}
+        self.sessions = set()
+        self.counter = Counter()
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self.handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def get_behavior(self, ulss):
+        return dict(self.default, **self.behavior.get(ulss, {}))
+
+    def fixture(self, name):
+        if name not in self.fixtures:
+            self.fixtures[name] = load_fixture(name)
+        return self.fixtures[name]
+
+    def count(self, key):
+        with self.lock:
+            self.counter[key] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counter)
+
+    def handler(self):
+        portal = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                portal.dispatch(self, "GET")
+
+            def do_POST(self):
+                portal.dispatch(self, "POST")
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def dispatch(self, request, method):
+        length = int(request.headers.get("Content-Length") or 0)
+        form = parse_qs(request.rfile.read(length).decode("utf8"))
+
+        for route_method, pattern, name in ROUTES:
+            match = pattern.match(request.path)
+            if route_method == method and match:
+                break
+        else:
+            self.count("not_found")
+            return self.respond(request, 404, "Not found")
+
+        ulss = int(match.group(1))
+        behavior = self.get_behavior(ulss)
+        self.count(name)
+
+        if behavior["latency"]:
+            sleep(behavior["latency"])
+        if self.random.random() < behavior["error_rate"]:
+            self.count("error")
+            return self.respond(request, 500, "Internal Server Error")
+
+        if name == "home":
+            session = uuid.uuid4().hex
+            with self.lock:
+                self.sessions.add(session)
+            return self.respond(request, 200, self.fixture("home"), session)
+
+        # Like the real portal, the flow only works with a valid session cookie
+        if self.session(request) not in self.sessions:
+            self.count("rejected")
+            return self.respond(request, 200, self.fixture("application_error"))
+
+        if name == "start":
+            fiscal_code = form.get("cod_fiscale", [""])[0]
+            fixture = behavior["fiscal_codes"].get(fiscal_code, behavior["start"])
+        else:
+            fixture = behavior[name]
+        return self.respond(request, 200, self.fixture(fixture))
+
+    def session(self, request):
+        cookies = request.headers.get("Cookie") or ""
+        for cookie in cookies.split(";"):
+            name, _, value = cookie.strip().partition("=")
+            if name == COOKIE:
+                return value
+
+    def respond(self, request, status, body, session=None):
+        body = body.encode("utf8")
+        request.send_response(status)
+        request.send_header("Content-Type", "text/html; charset=utf-8")
+        request.send_header("Content-Length", str(len(body)))
+        if session:
+            request.send_header("Set-Cookie", f"{COOKIE}={session}; Path=/")
+        request.end_headers()
+        request.wfile.write(body)
+
+    def expire_sessions(self):
+        with self.lock:
+            self.sessions.clear()
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, args=(0.05,), daemon=True
+        )
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a fake vaccination portal.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0, help="seconds")
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--start", default=DEFAULT_BEHAVIOR["start"])
+    parser.add_argument("--seed", type=int)
+    parser.add_argument(
+        "--behavior",
+        type=json.loads,
+        default={},
+        help='per ULSS behavior as JSON, e.g. \'{"1": {"start": "not_eligible"}}\'',
+    )
+    args = parser.parse_args()
+
+    portal = FakePortal(
+        args.host,
+        args.port,
+        behavior=args.behavior,
+        seed=args.seed,
+        start=args.start,
+        latency=args.latency,
+        error_rate=args.error_rate,
+    )
+    print(f"Fake portal listening on {portal.url}")
+    try:
+        portal.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(portal.stats()))
+        portal.server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# Adapt how often subscriptions are checked to how often what they see
+# actually changes, per ULSS and state (a cohort). Every check is an
+# observation: how long since the previous check, whether the state or the
+# available locations changed, and which locations opened. From those we
+# estimate, per subscription:
+#
+# - the mean time between changes, `elapsed / changes`;
+# - the mean time a location stays open, `open_time / opened` (Little's law:
+#   locations open on average over locations opened per second).
+#
+# The interval is the shortest of the two divided by `CHECKS_PER_CHANGE`,
+# within the `BOUNDS` of the state, or the upper bound if changes are rarer
+# than that. Observations lose half of their weight
+# every `HALF_LIFE` seconds, so the interval follows the portal.
+
+import json
+
+from . import db
+
+# States not here keep the update interval of the `status` table
+BOUNDS = {
+    "eligible": (10 * 60, 2 * 60 * 60),
+    "maybe_eligible": (10 * 60, 2 * 60 * 60),
+    "not_eligible": (60 * 60, 12 * 60 * 60),
+}
+HALF_LIFE = 24 * 60 * 60
+# Check at least this many times while a location is open
+CHECKS_PER_CHANGE = 2
+# Seconds of observations (summed over subscriptions) before adapting
+MIN_ELAPSED = 6 * 60 * 60
+# Don't touch the interval for changes smaller than this ratio, every change
+# reschedules the whole cohort
+HYSTERESIS = 0.2
+
+
+def slots(locations, path=()):
+    # The available locations as a set of paths, `locations` is a tree of
+    # dicts with lists of locations as leaves
+    if not locations:
+        return set()
+    if isinstance(locations, dict):
+        return set().union(*(slots(v, path + (k,)) for k, v in locations.items()))
+    return {path + (l,) for l in locations}
+
+
+def target(changes, elapsed, opened, open_time, bounds):
+    # The interval for the observations, `None` if there are not enough
+    low, high = bounds
+    if elapsed < MIN_ELAPSED:
+        return None
+    # Nothing moves, whatever the locations did back then
+    if not changes or elapsed / changes >= high * CHECKS_PER_CHANGE:
+        return high
+    period = elapsed / changes
+    if opened > 0:
+        period = min(period, open_time / opened)
+    return int(max(low, period / CHECKS_PER_CHANGE))
+
+
+def observe(c, s, status_id, locations, now):
+    # Record the check of subscription `s` (a row of `subscription.by_id`)
+    # that found `status_id` and the available `locations`. Return the
+    # update interval of the cohort, `None` if it's not adapted.
+    bounds = BOUNDS.get(s["status_id"])
+    if not bounds or not s["last_check"]:
+        return None
+    high = bounds[1]
+    # Don't let a long outage weight more than a few checks
+    period = min(now - s["last_check"], 2 * high)
+    if period < 0:
+        return None
+
+    before = slots(json.loads(s["locations"]))
+    after = slots(locations)
+    row = db.check_interval.get(c, s["ulss_id"], s["status_id"])
+    decay = 0.5 ** ((now - row["observed_at"]) / HALF_LIFE) if row else 0
+    # Moving to a state we don't adapt is about the person, not the portal
+    moved = status_id in BOUNDS and status_id != s["status_id"]
+    changes = (row["changes"] if row else 0) * decay + (moved or before != after)
+    elapsed = (row["elapsed"] if row else 0) * decay + period
+    opened = (row["opened"] if row else 0) * decay + len(after - before)
+    open_time = (row["open_time"] if row else 0) * decay + len(before) * period
+
+    current = row["update_interval"] if row else None
+    interval = target(changes, elapsed, opened, open_time, bounds)
+    if current and interval and abs(interval - current) <= HYSTERESIS * current:
+        interval = current
+    db.check_interval.save(
+        c,
+        s["ulss_id"],
+        s["status_id"],
+        changes,
+        elapsed,
+        opened,
+        open_time,
+        now,
+        interval,
+    )
+    return interval
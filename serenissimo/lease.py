@@ -0,0 +1,91 @@
+# Split the subscriptions to check between checker processes, on one or more
+# machines sharing the DB. Every process claims a batch of stale subscriptions
+# with a lease (see `db.lease`), renews the leases while the checks are in
+# progress, and gives them up when done. Leases of a process that died expire
+# after `ttl` seconds, and other processes take them over. Subscriptions
+# already due when the process starts are spread over `window` seconds.
+
+import logging
+import os
+import socket
+import sqlite3
+from time import time
+
+from . import db
+
+log = logging.getLogger()
+
+
+def default_owner():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class Leases:
+    def __init__(
+        self,
+        owner=None,
+        ttl=5 * 60,
+        batch=100,
+        window=15 * 60,
+        database="db.sqlite",
+        clock=time,
+    ):
+        self.owner = owner or default_owner()
+        self.ttl = ttl
+        self.batch = batch
+        self.window = window
+        self.database = database
+        self.clock = clock
+        self.started = int(clock())
+
+    def select_due(self):
+        # The subscriptions due for a check we got a lease for, as rows of
+        # `select_stale`
+        now = int(self.clock())
+        with db.transaction(self.database, row_factory=sqlite3.Row) as t:
+            subscriptions = db.lease.select_stale(
+                t, now, self.batch, self.started, self.window
+            ).fetchall()
+            claimed = db.lease.claim(
+                t,
+                self.owner,
+                [s["subscription_id"] for s in subscriptions],
+                now,
+                now + self.ttl,
+            )
+        return [s for s in subscriptions if s["subscription_id"] in claimed]
+
+    def renew(self, subscription_ids):
+        subscription_ids = list(subscription_ids)
+        if not subscription_ids:
+            return 0
+        with db.transaction(self.database) as t:
+            renewed = db.lease.extend(
+                t, self.owner, subscription_ids, int(self.clock()) + self.ttl
+            )
+        if renewed < len(subscription_ids):
+            log.warning(
+                "Lost %s leases, taken over by other checkers",
+                len(subscription_ids) - renewed,
+            )
+        return renewed
+
+    def release(self, subscription_ids, hold=0):
+        # Keep the leases for `hold` more seconds, so a subscription whose
+        # check failed is not tried again right away by someone else
+        subscription_ids = list(subscription_ids)
+        with db.transaction(self.database) as t:
+            if hold:
+                db.lease.extend(
+                    t, self.owner, subscription_ids, int(self.clock()) + hold
+                )
+            else:
+                db.lease.release(t, self.owner, subscription_ids)
+
+    def release_all(self):
+        with db.transaction(self.database) as t:
+            db.lease.release(t, self.owner)
+
+    def delete_expired(self):
+        with db.transaction(self.database) as t:
+            db.lease.delete_expired(t, int(self.clock()))
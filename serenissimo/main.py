@@ -3,8 +3,8 @@ import logging
 import os
 import sys
 import re
+import sqlite3
 import traceback
-from collections import Counter
 from threading import Thread
 from time import sleep, time
 
@@ -17,9 +17,18 @@ from . import snooze
 from . import feedback
 from . import stats
 from . import db
+from . import agent
+from . import due
+from . import interval
+from .cache import TTLCache
+from .lease import Leases
+from .probe import Probes
+from .scheduler import Scheduler
+from .writer import Writer
 from .agent import (
     HTTPException,
     ApplicationException,
+    CircuitOpen,
     UnknownPayload,
     check,
     format_locations,
@@ -30,6 +39,32 @@ log = logging.getLogger()
 
 DEV = os.getenv("DEV")
 ADMIN_ID = os.getenv("ADMIN_ID")
+# Share location pages between checks for this many seconds (0 to disable)
+LOCATION_CACHE_TTL = int(os.getenv("LOCATION_CACHE_TTL", "0"))
+# Check one subscription per group of subscriptions seeing the same location
+# pages, and the whole group only if something changed or if it wasn't checked
+# for this many seconds (0 to check every subscription)
+PROBE_MAX_AGE = int(os.getenv("PROBE_MAX_AGE", "0"))
+# How many subscriptions to check at the same time
+CHECK_WORKERS = int(os.getenv("CHECK_WORKERS", "4"))
+# Seconds to wait before checking again a subscription whose check failed
+CHECK_RETRY = 60
+# Where subscriptions are checked: "bot" in the bot process only, "lease" in the
+# bot process and in `python -m serenissimo.checker` processes sharing the DB,
+# "off" in checker processes only
+CHECK_MODE = os.getenv("CHECK_MODE", "bot")
+# Spread the checks of subscriptions already due at startup, or waking up from
+# a snooze, over this many seconds
+CATCH_UP_WINDOW = int(os.getenv("CATCH_UP_WINDOW", str(due.CATCH_UP_WINDOW)))
+# Adapt the update interval of every ULSS and state to how often locations
+# change, within `interval.BOUNDS`
+ADAPTIVE_INTERVALS = int(os.getenv("ADAPTIVE_INTERVALS", "0"))
+# Write the results of the checks in batches of this many rows, or after this
+# many milliseconds
+WRITE_BATCH_ROWS = int(os.getenv("WRITE_BATCH_ROWS", "100"))
+WRITE_BATCH_MS = int(os.getenv("WRITE_BATCH_MS", "500"))
+
+writer = Writer(WRITE_BATCH_ROWS, WRITE_BATCH_MS / 1000)
 
 
 def gen_markup_ulss(current=None):
@@ -76,6 +111,7 @@ def send_welcome(message):
     with db.transaction() as t:
         user = db.user.by_telegram_id(t, telegram_id)
         if user:
+            due.remove_user(t, user["id"])
             db.user.delete(t, user["id"])
         db.user.insert(t, telegram_id)
 
@@ -225,7 +261,8 @@ def health_insurance_number_message(message):
     ):
         return send_welcome(message)
 
-    state_id, notified = notify_locations(subscription["id"], sync=True)
+    state_id, notified, _ = notify_locations(subscription["id"], sync=True)
+    due.reschedule([subscription["id"]])
     send_stats()
 
 
@@ -240,7 +277,10 @@ def check_message(message):
         if user:
             subscription = db.subscription.last_by_user(c, user["id"])
     if user and subscription:
-        state, notified = notify_locations(subscription["id"], sync=True)
+        state, notified, _ = notify_locations(
+            subscription["id"], sync=True, recheck=True
+        )
+        due.reschedule([subscription["id"]])
     else:
         send_welcome(message)
 
@@ -254,6 +294,7 @@ def delete_message(message):
     with db.transaction() as t:
         user = db.user.by_telegram_id(t, telegram_id)
         if user:
+            due.remove_user(t, user["id"])
             db.user.delete(t, user["id"])
     send_message(
         telegram_id,
@@ -271,6 +312,7 @@ def vaccinated_message(message):
     with db.transaction() as t:
         user = db.user.by_telegram_id(t, telegram_id)
         if user:
+            due.remove_user(t, user["id"])
             db.user.delete(t, user["id"])
             db.log.insert(t, "vaccinated")
     send_message(
@@ -312,7 +354,8 @@ def send_info(message):
 
 
 def send_stats():
-    s = db.stats.select(db.connect())
+    with db.connection() as c:
+        s = db.stats.select(c)
     send_message(
         ADMIN_ID,
         f"Users: {s['users']}",
@@ -330,12 +373,15 @@ def broadcast_message(message):
         return
     total = 0
     start = time()
-    with db.connection() as c:
-        for user in db.user.select_active(c):
-            total += 1
-            telegram_id = user["telegram_id"]
-            log.info("Broadcast message to %s", telegram_id)
-            send_message(telegram_id, text)
+    # Sending can delete users who blocked us, on the same connection: don't
+    # keep the cursor open meanwhile
+    with db.connection(row_factory=sqlite3.Row) as c:
+        users = db.user.select_active(c).fetchall()
+    for user in users:
+        total += 1
+        telegram_id = user["telegram_id"]
+        log.info("Broadcast message to %s", telegram_id)
+        send_message(telegram_id, text)
     end = time()
     send_message(ADMIN_ID, f"Sent {total} messages in {end-start:.2}s")
 
@@ -351,26 +397,54 @@ def fallback_message(message):
     )
 
 
-def notify_locations(subscription_id, sync=False):
+def notify_locations(subscription_id, sync=False, recheck=False):
     with db.connection() as c:
         s = db.subscription.by_id(c, subscription_id)
 
     if not s or not s["ulss_id"] or not s["fiscal_code"]:
-        return None, None
+        return None, None, None
 
     telegram_id = s["telegram_id"]
     fiscal_code = s["fiscal_code"]
     health_insurance_number = s["health_insurance_number"]
     ulss_id = s["ulss_id"]
-    old_locations = json.loads(s["locations"])
+
+    # Don't ask the portal what we already know (like when users enter the
+    # same data again), unless they asked to check again with /controlla:
+    # they might have cancelled their booking. The new state replaces the one
+    # in the cache.
+    known_status_id = None
+    if not recheck:
+        with db.connection() as c:
+            known_status_id = db.negative_cache.get(
+                c, ulss_id, fiscal_code, health_insurance_number
+            )
 
     try:
-        status_id, available_locations, unavailable_locations = check(
-            ulss_id, fiscal_code, health_insurance_number
+        if known_status_id:
+            status_id = known_status_id
+            available_locations, unavailable_locations = None, None
+        else:
+            status_id, available_locations, unavailable_locations = check(
+                ulss_id, fiscal_code, health_insurance_number
+            )
+    except CircuitOpen:
+        # The portal of this ULSS is down, don't touch the subscription so
+        # it's checked again as soon as the portal is back.
+        log.warning(
+            "Skip check for telegram_id %s, ulss_id %s, portal is down",
+            telegram_id,
+            ulss_id,
         )
+        if sync:
+            send_message(
+                telegram_id,
+                "Errore: non riesco a contattare il portale della Regione. ",
+                "Il problema è temporaneo, riprova tra qualche minuto.",
+            )
+        return None, None, None
     except HTTPException:
-        with db.transaction() as t:
-            db.log.insert(t, "http-error", ulss_id)
+        write(sync, db.log.insert, "http-error", ulss_id)
         log.error(
             "HTTP Error for telegram_id %s, ulss_id %s, fiscal_code %s",
             telegram_id,
@@ -385,10 +459,9 @@ def notify_locations(subscription_id, sync=False):
                 "Errore: non riesco a contattare il portale della Regione. ",
                 "Il problema è temporaneo, riprova tra qualche minuto.",
             )
-        return None, None
+        return None, None, None
     except ApplicationException:
-        with db.transaction() as t:
-            db.log.insert(t, "application-error", ulss_id)
+        write(sync, db.log.insert, "application-error", ulss_id)
         log.error(
             "Application Error for telegram_id %s, ulss_id %s, fiscal_code %s",
             telegram_id,
@@ -408,10 +481,9 @@ def notify_locations(subscription_id, sync=False):
                 "Se il portale funziona ma Serenissimo no, per favore "
                 "contattami su agranzot@mailbox.org.",
             )
-        return None, None
+        return None, None, None
     except UnknownPayload:
-        with db.transaction() as t:
-            db.log.insert(t, "payload-error", ulss_id)
+        write(sync, db.log.insert, "payload-error", ulss_id)
         log.exception(
             "Payload Error for telegram_id %s, ulss_id %s, fiscal_code %s",
             telegram_id,
@@ -431,13 +503,18 @@ def notify_locations(subscription_id, sync=False):
                 "Se il portale funziona ma Serenissimo no, per favore "
                 "contattami su agranzot@mailbox.org.",
             )
-        return None, None
-
-    formatted_available = format_locations(available_locations)
-    formatted_unavailable = format_locations(unavailable_locations, limit=500)
-    formatted_old = format_locations(old_locations)
+        return None, None, None
 
-    should_notify = formatted_available != formatted_old and available_locations
+    locations = json.dumps(available_locations)
+    if not sync and locations == s["locations"]:
+        # Same locations as last time, nothing to format and nothing to notify
+        formatted_available = None
+        should_notify = False
+    else:
+        formatted_available = format_locations(available_locations)
+        formatted_unavailable = format_locations(unavailable_locations, limit=500)
+        formatted_old = format_locations(json.loads(s["locations"]))
+        should_notify = formatted_available != formatted_old and available_locations
 
     log.info(
         "Check telegram_id %s, CF %s, ULSS %s, state %s",
@@ -549,41 +626,102 @@ def notify_locations(subscription_id, sync=False):
             "<i>per alcune prenotazioni è richiesta l'autocertificazione</i>.",
             reply_markup=feedback.gen_markup_init(snooze.gen_markup_init()),
         )
-    with db.transaction() as t:
+    now = time()
+
+    def save(t):
         db.subscription.update(
             t,
             subscription_id,
             status_id=status_id,
-            locations=json.dumps(available_locations),
+            locations=locations,
             set_last_check=True,
         )
-    return status_id, should_notify
+        if not known_status_id:
+            db.negative_cache.update(
+                t, ulss_id, fiscal_code, health_insurance_number, status_id
+            )
+            if ADAPTIVE_INTERVALS:
+                interval.observe(t, s, status_id, available_locations, now)
+
+    write(sync, save)
+    return status_id, should_notify, locations
+
+
+def write(sync, fn, *args, **kwargs):
+    # Checks write in the background, handlers right away. Both go through the
+    # writer, so an older background write doesn't overwrite a newer one.
+    writer.submit(fn, *args, **kwargs)
+    if sync:
+        writer.flush()
+
+
+def check_subscription(s):
+    # Return the locations as they will be stored in the DB
+    state, notified, locations = notify_locations(s["subscription_id"])
+    if notified:
+        writer.submit(db.log.insert, "notification", s["ulss_id"])
+    return locations
 
 
-def check_loop():
+def skip_subscription(s):
+    writer.submit(db.subscription.update, s["subscription_id"], set_last_check=True)
+
+
+def handle(job, run, done):
+    try:
+        run(job)
+    finally:
+        # Once the results are in the DB
+        ids = [s["subscription_id"] for s in job]
+        writer.defer(lambda: done(ids))
+
+
+def check_loop(leases=None):
+    # Check subscriptions as they get due, forever. With `leases`, share them
+    # with other checker processes.
     if not DEV:
         sleep(60)
+    if leases:
+        select, until, wakeup = leases.select_due, None, None
+        # Try again in a while if the check didn't go through
+        done = lambda ids: leases.release(ids, hold=CHECK_RETRY)
+    else:
+        log.info("Loaded %s subscriptions to check", due.load(window=CATCH_UP_WINDOW))
+        select = lambda: due.select_due(window=CATCH_UP_WINDOW)
+        until, wakeup = due.queue.next_in, due.queue.wakeup
+        done = lambda ids: due.reschedule(ids, retry_at=time() + CHECK_RETRY)
+    if PROBE_MAX_AGE:
+        probes = Probes(PROBE_MAX_AGE)
+        run = lambda job: probes.run_job(job, check_subscription, skip_subscription)
+        group = probes.jobs
+    else:
+        run = lambda job: check_subscription(job[0])
+        group = None
+    scheduler = Scheduler(
+        select,
+        lambda job: handle(job, run, done),
+        workers=CHECK_WORKERS,
+        idle=CHECK_RETRY,
+        group=group,
+        until=until,
+        wakeup=wakeup,
+    )
+    scheduler.start()
+    cleanup = renew = time()
     while True:
-        counter = Counter()
-        start = time()
-        with db.connection() as c:
-            for s in db.subscription.select_stale(c):
-                counter["total"] += 1
-                state, notified = notify_locations(s["subscription_id"])
-                counter[state] += 1
-                if notified:
-                    counter["notified"] += 1
-                    with db.transaction() as t:
-                        db.log.insert(t, "notification", s["ulss_id"])
-        end = time()
-        # if stats["total"] > 0:
-        #    send_message(
-        #        ADMIN_ID,
-        #        "🏁 Done checking for locations",
-        #        "\n".join(f"{k} {v}" for k, v in stats.items()),
-        #        f"Total time: {end-start:.2f}s",
-        #    )
         sleep(60)
+        # Compile the next snooze window of the users waking up
+        with db.transaction() as t:
+            db.user.roll_snooze(t, time())
+        if leases and time() - renew >= leases.ttl / 3:
+            renew = time()
+            leases.renew(scheduler.pending_ids())
+        if time() - cleanup >= 60 * 60:
+            cleanup = time()
+            with db.transaction() as t:
+                db.negative_cache.delete_expired(t)
+            if leases:
+                leases.delete_expired()
 
 
 if __name__ == "__main__":
@@ -591,7 +729,13 @@ if __name__ == "__main__":
     with db.transaction() as t:
         db.init(t)
         db.init_data(t)
-    Thread(target=check_loop, daemon=True).start()
+    if LOCATION_CACHE_TTL:
+        agent.location_cache = TTLCache(ttl=LOCATION_CACHE_TTL)
+    if CHECK_MODE == "bot":
+        Thread(target=check_loop, daemon=True).start()
+    elif CHECK_MODE == "lease":
+        leases = Leases(batch=CHECK_WORKERS * 4, window=CATCH_UP_WINDOW)
+        Thread(target=check_loop, args=(leases,), daemon=True).start()
     apihelper.SESSION_TIME_TO_LIVE = 5 * 60
     try:
         bot.polling()
@@ -601,3 +745,5 @@ if __name__ == "__main__":
         stack = traceback.format_exception(*sys.exc_info())
         send_message(ADMIN_ID, "🤬🤬🤬\n" + "".join(stack))
         print("".join(stack))
+    finally:
+        writer.stop()
@@ -0,0 +1,21 @@
+from serenissimo import db
+
+MIGRATION = [
+    "ALTER TABLE subscription ADD COLUMN next_check_at INTEGER NOT NULL DEFAULT 0",
+    """
+    CREATE INDEX IF NOT EXISTS idx_subscription_next_check_at
+    ON subscription(next_check_at, status_id)""",
+    # Due `status.update_interval` seconds after the last check, the view and
+    # the triggers created at startup keep it up to date from now on
+    """
+    UPDATE subscription
+    SET next_check_at = last_check + (
+        SELECT update_interval
+        FROM status
+        WHERE status.id = subscription.status_id
+    )""",
+]
+
+with db.transaction() as t:
+    for statement in MIGRATION:
+        t.execute(statement)
@@ -0,0 +1,29 @@
+from serenissimo import db
+
+SELECT = """
+SELECT subscription.id,
+    subscription.last_check,
+    status.update_interval
+FROM subscription
+    INNER JOIN status ON (status.id = subscription.status_id)
+"""
+
+UPDATE = "UPDATE subscription SET next_check_at = ? WHERE id = ?"
+
+
+def in_phase(subscription_id, last_check, interval):
+    # Move back by less than an interval to get in phase, as `view_next_check`
+    offset = subscription_id * 2654435761 % 2**32 * interval // 2**32
+    due = last_check + interval
+    return due - (due - offset) % interval
+
+
+with db.transaction(row_factory=None) as t:
+    # Put every subscription in its phase
+    t.executemany(
+        UPDATE,
+        [
+            (in_phase(subscription_id, last_check, interval), subscription_id)
+            for subscription_id, last_check, interval in t.execute(SELECT).fetchall()
+        ],
+    )
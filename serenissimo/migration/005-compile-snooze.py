@@ -0,0 +1,34 @@
+from time import time
+
+from serenissimo import db
+
+MIGRATION = [
+    "ALTER TABLE user ADD COLUMN snooze_start_at INTEGER NULL",
+    "ALTER TABLE user ADD COLUMN snooze_end_at INTEGER NULL",
+    "CREATE INDEX IF NOT EXISTS idx_user_snooze_end_at ON user(snooze_end_at)",
+]
+
+# Subscriptions due during the snooze window wake up in the first 15 minutes
+# after it, as in `view_next_check`
+UPDATE = """
+UPDATE subscription
+SET next_check_at = (
+        SELECT snooze_end_at
+        FROM user
+        WHERE user.id = subscription.user_id
+    ) + id * 2654435761 % 4294967296 * 15 * 60 / 4294967296
+WHERE EXISTS (
+        SELECT 1
+        FROM user
+        WHERE user.id = subscription.user_id
+            AND subscription.next_check_at >= user.snooze_start_at
+            AND subscription.next_check_at < user.snooze_end_at
+    )
+"""
+
+with db.transaction() as t:
+    for statement in MIGRATION:
+        t.execute(statement)
+    # Compile the snooze window of every user
+    db.user.roll_snooze(t, time())
+    t.execute(UPDATE)
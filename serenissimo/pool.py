@@ -0,0 +1,69 @@
+import threading
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+import requests
+
+
+class SessionPool:
+    # Keep a few `requests.Session` objects alive for every ULSS, so checks can
+    # reuse both the TCP/TLS connection and the cookie the portal gave us.
+    #
+    # A session is handed out to one check at a time: the portal keeps the
+    # state of the booking flow server side, attached to the cookie, so two
+    # concurrent checks must never share a session.
+
+    def __init__(self, size=4, factory=requests.Session):
+        self.size = size
+        self.factory = factory
+        self.lock = threading.Lock()
+        self.idle = defaultdict(list)
+        self.counter = Counter()
+
+    @contextmanager
+    def session(self, ulss):
+        with self.lock:
+            if self.idle[ulss]:
+                session = self.idle[ulss].pop()
+                self.counter["reused"] += 1
+            else:
+                session = self.factory()
+                self.counter["created"] += 1
+        try:
+            yield session
+        except:
+            # Something went wrong, we don't know in which state the
+            # connection or the portal session are, so throw it away.
+            self.discard(session)
+            raise
+        else:
+            self.release(ulss, session)
+
+    def release(self, ulss, session):
+        with self.lock:
+            if len(self.idle[ulss]) < self.size:
+                self.idle[ulss].append(session)
+                return
+        self.discard(session)
+
+    def discard(self, session):
+        with self.lock:
+            self.counter["discarded"] += 1
+        session.close()
+
+    def count(self, key):
+        with self.lock:
+            self.counter[key] += 1
+
+    def clear(self):
+        with self.lock:
+            sessions = [s for idle in self.idle.values() for s in idle]
+            self.idle.clear()
+        for session in sessions:
+            session.close()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counter)
+            stats["idle"] = {ulss: len(idle) for ulss, idle in self.idle.items()}
+        return stats
@@ -0,0 +1,95 @@
+import threading
+from collections import Counter
+from time import monotonic
+
+from . import agent
+
+
+class Probes:
+    # Subscriptions in the same ULSS, in the same state, and reaching the same
+    # location pages see the same locations. Check one of them (the probe),
+    # and check the others only if the locations changed since the last probe,
+    # if they have different locations stored, or if they weren't checked for
+    # `max_age` seconds. Subscriptions we don't know the path of yet are
+    # checked one by one.
+
+    def __init__(self, max_age=30 * 60, clock=monotonic):
+        self.max_age = max_age
+        self.clock = clock
+        # Group key -> (locations of the last probe, time of the last fan out)
+        self.groups = {}
+        self.counter = Counter()
+        self.lock = threading.Lock()
+
+    def key(self, s):
+        if agent.paths is None:
+            return None
+        path = agent.paths.get(
+            (s["ulss_id"], s["fiscal_code"], s["health_insurance_number"])
+        )
+        if path is None:
+            return None
+        url, found = path
+        return s["ulss_id"], s["status_id"], url, tuple(found)
+
+    def jobs(self, subscriptions):
+        # Split `subscriptions` in jobs: a subscription we don't know the path
+        # of on its own, or a group with the probe first
+        now = self.clock()
+        with self.lock:
+            for key, (_, fanned_out) in list(self.groups.items()):
+                if now - fanned_out >= self.max_age:
+                    del self.groups[key]
+
+        singles, groups = [], {}
+        for s in subscriptions:
+            key = self.key(s)
+            if key is None:
+                singles.append([s])
+            else:
+                groups.setdefault(key, []).append(s)
+        return singles + list(groups.values())
+
+    def run_job(self, job, check, skip):
+        # `check(s)` checks a subscription and returns its locations as stored
+        # in the DB, or `None` if the check failed. `skip(s)` marks a
+        # subscription as checked without checking it.
+        probe, *others = job
+        key = self.key(probe) if others else None
+        if key is None:
+            self.count("single")
+            for s in job:
+                check(s)
+            return
+
+        self.count("probes")
+        locations = check(probe)
+        # Try again with the next round, the portal might be down
+        if locations is None:
+            return
+
+        with self.lock:
+            last = self.groups.get(key)
+            fan_out = last is None or last[0] != locations
+            self.groups[key] = (locations, self.clock() if fan_out else last[1])
+        for s in others:
+            if fan_out or s["locations"] != locations:
+                self.count("checked")
+                check(s)
+            else:
+                self.count("skipped")
+                skip(s)
+
+    def run(self, subscriptions, check, skip):
+        for job in self.jobs(subscriptions):
+            self.run_job(job, check, skip)
+
+    def count(self, key):
+        with self.lock:
+            self.counter[key] += 1
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counter)
+            stats["groups"] = len(self.groups)
+        return stats
@@ -0,0 +1,165 @@
+import re
+import threading
+from collections import Counter
+from functools import lru_cache
+from html import unescape
+
+from .cache import TTLCache
+
+# Matches the JavaScript calls the portal uses to move between steps, like
+# `act_step(2,101)`, `inviacf(152)`, or `sceglicorte()`.
+RE_CALL = re.compile(r"(\w+)\s*\(\s*([\d\s,]*)\)")
+
+# The only elements we care about are buttons and scripts, match both in a
+# single pass over the payload.
+RE_ELEMENT = re.compile(
+    r"<button\b([^>]*)>(.*?)(?:</button\s*>|$)|<script\b[^>]*>(.*?)(?:</script\s*>|$)",
+    re.DOTALL | re.IGNORECASE,
+)
+RE_ATTRIBUTE = re.compile(
+    r"""([^\s=/>]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+)))?"""
+)
+RE_TAG = re.compile(r"<[^>]*>")
+RE_REDIRECT = re.compile(r" *<script\b[^>]*>(.*?)(?:</script\s*>|$)", re.DOTALL)
+
+
+def parse_args(args):
+    return tuple(filter(None, map(str.strip, args.split(","))))
+
+
+def parse_calls(code):
+    return [(name, parse_args(args)) for name, args in RE_CALL.findall(code)]
+
+
+@lru_cache(maxsize=None)
+def call_pattern(name):
+    # A pattern starting with a literal is way faster to look for than the
+    # generic `RE_CALL`
+    return re.compile(re.escape(name) + r"\s*\(\s*([\d\s,]*)\)")
+
+
+def parse_attributes(attributes):
+    return {
+        name.lower(): unescape(double or single or bare)
+        for name, double, single, bare in RE_ATTRIBUTE.findall(attributes)
+    }
+
+
+class Button:
+    __slots__ = ("onclick", "classes", "disabled", "text", "calls")
+
+    def __init__(self, onclick, classes, disabled, text):
+        self.onclick = onclick
+        self.classes = classes
+        self.disabled = disabled
+        self.text = text
+        self.calls = parse_calls(onclick) if onclick else []
+
+    def is_back(self):
+        return (
+            "act_step(1)" in self.onclick
+            or "sceglicorte" in self.onclick
+            or "btn-back" in self.classes
+        )
+
+
+class Page:
+    # A payload from the portal. Every part of it is scanned at most once, and
+    # only if needed: `start` just looks at the calls, while `extract_urls` and
+    # `extract_locations` need the buttons.
+    __slots__ = ("html", "_buttons", "_scripts", "_memo")
+
+    def __init__(self, html):
+        self.html = html
+        self._buttons = None
+        self._scripts = None
+        self._memo = {}
+
+    @property
+    def buttons(self):
+        if self._buttons is None:
+            self.scan_elements()
+        return self._buttons
+
+    @property
+    def scripts(self):
+        if self._scripts is None:
+            self.scan_elements()
+        return self._scripts
+
+    def scan_elements(self):
+        buttons = []
+        scripts = []
+        for match in RE_ELEMENT.finditer(self.html):
+            attributes, text, script = match.groups()
+            if script is not None:
+                scripts.append(script)
+            else:
+                attributes = parse_attributes(attributes)
+                buttons.append(
+                    Button(
+                        attributes.get("onclick", ""),
+                        attributes.get("class", "").split(),
+                        "disabled" in attributes,
+                        unescape(RE_TAG.sub("", text)),
+                    )
+                )
+        self._buttons = buttons
+        self._scripts = scripts
+
+    def find(self, name, step=None):
+        # Return the arguments of all calls to `name` in the payload. If `step`
+        # is given, only calls with `step` as their first argument are
+        # considered.
+        calls = map(parse_args, call_pattern(name).findall(self.html))
+        return [args for args in calls if args and (step is None or args[0] == step)]
+
+    def redirect(self):
+        # Some pages are just a script that moves the user to the next step
+        match = RE_REDIRECT.match(self.html)
+        if match:
+            calls = parse_calls(match.group(1))
+            if calls:
+                return calls[0]
+        return None, ()
+
+    def memo(self, key, fn):
+        # Results derived from the payload are computed once per payload, and
+        # reused when the portal sends it again
+        if key in self._memo:
+            with reused_lock:
+                reused[key[0]] += 1
+            return self._memo[key]
+        result = self._memo[key] = fn(self)
+        return result
+
+
+reused = Counter()
+reused_lock = threading.Lock()
+
+# Most checks get exactly the same payloads as last time. Pages are kept by
+# their payload, so a payload seen before is not scanned again, whether it
+# comes from a later check of the same subscription, or another subscription
+# landing on the same page.
+# The payload itself is the key: Python hashes a string once and keeps the
+# hash, and the page holds the string anyway.
+pages = TTLCache(ttl=3600, maxsize=1024)
+
+
+def scan(html):
+    page = pages.get(html)
+    if page is None:
+        page = Page(html)
+        pages.set(html, page)
+    return page
+
+
+def clear():
+    pages.clear()
+
+
+def stats():
+    with reused_lock:
+        stats = {"reused": dict(reused)}
+    stats["pages"] = pages.stats()
+    return stats
@@ -0,0 +1,231 @@
+import heapq
+import logging
+import queue
+import threading
+from collections import Counter, deque
+from time import monotonic, time
+
+log = logging.getLogger()
+
+
+def phase(subscription_id):
+    # A stable fraction in [0, 1) for every subscription, spread evenly for
+    # consecutive ids (Knuth's multiplicative hash, as in `view_next_check`)
+    return subscription_id * 2654435761 % 2**32 / 2**32
+
+
+def catch_up(subscription_id, at, since, window):
+    # Subscriptions due before `since` are spread over the `window` seconds
+    # after it, instead of being all due at once
+    if at >= since:
+        return at
+    return since + phase(subscription_id) * window
+
+
+class Scheduler:
+    # Keep a pool of `workers` threads busy checking subscriptions.
+    #
+    # `select()` returns the subscriptions due for a check (rows with a
+    # `subscription_id`), `group(subscriptions)` splits them in jobs (lists of
+    # subscriptions handled by the same worker, one subscription per job by
+    # default), and `handle(job)` runs a job.
+    #
+    # As long as there are subscriptions due, the workers are fed without
+    # pauses. When there's nothing new to do, wait `idle` seconds before
+    # looking again, or less if `until()` says something is due sooner.
+    # Setting `wakeup` makes the scheduler look again right away.
+    #
+    # Subscriptions queued or being checked are never selected twice. Waiting
+    # before trying again a subscription whose check failed is up to
+    # `select()`.
+
+    def __init__(
+        self,
+        select,
+        handle,
+        workers=4,
+        idle=60,
+        group=None,
+        until=None,
+        wakeup=None,
+        clock=monotonic,
+    ):
+        self.select = select
+        self.handle = handle
+        self.group = group or (lambda subscriptions: [[s] for s in subscriptions])
+        self.workers = workers
+        self.idle = idle
+        self.until = until
+        self.wakeup = wakeup or threading.Event()
+        self.clock = clock
+        self.queue = queue.Queue(maxsize=workers * 2)
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.threads = []
+        # Subscriptions selected and not done yet: waiting for a place in the
+        # queue, queued, or being checked
+        self.pending = set()
+        self.in_flight = 0
+        # When the last jobs were done, to compute the rate
+        self.done = deque()
+        self.counter = Counter()
+
+    def start(self):
+        for i in range(self.workers):
+            self.threads.append(
+                threading.Thread(target=self.work, name=f"worker-{i}", daemon=True)
+            )
+        self.threads.append(
+            threading.Thread(target=self.feed, name="feeder", daemon=True)
+        )
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        self.wakeup.set()
+        for _ in range(self.workers):
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        # Jobs not handled by the time the workers stopped are not going to be
+        # handled
+        with self.lock:
+            self.pending.clear()
+
+    def due(self):
+        subscriptions = self.select()
+        with self.lock:
+            return [
+                s for s in subscriptions if s["subscription_id"] not in self.pending
+            ]
+
+    def feed(self):
+        while not self.stopping.is_set():
+            self.wakeup.clear()
+            try:
+                jobs = self.group(self.due())
+            except Exception:
+                log.exception("Error selecting subscriptions to check")
+                jobs = []
+            with self.lock:
+                self.counter["rounds"] += 1
+            log.info("Scheduler %s", self.stats())
+            if not jobs:
+                self.wakeup.wait(self.sleep_time())
+                continue
+            # All of them are pending right away, even the jobs still waiting
+            # for a place in the queue, so their leases get renewed too
+            with self.lock:
+                self.pending.update(s["subscription_id"] for job in jobs for s in job)
+            for job in jobs:
+                # Blocks while the workers are busy
+                self.queue.put(job)
+                if self.stopping.is_set():
+                    break
+
+    def pending_ids(self):
+        # Subscriptions selected and not done yet
+        with self.lock:
+            return list(self.pending)
+
+    def sleep_time(self):
+        until = self.until() if self.until else None
+        return self.idle if until is None else min(self.idle, until)
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            with self.lock:
+                self.in_flight += 1
+            try:
+                self.handle(job)
+            except Exception:
+                log.exception("Error checking subscriptions")
+            finally:
+                now = self.clock()
+                with self.lock:
+                    self.in_flight -= 1
+                    for s in job:
+                        self.pending.discard(s["subscription_id"])
+                    self.counter["checked"] += len(job)
+                    self.done.append((now, len(job)))
+
+    def rate(self, window=60):
+        # Subscriptions handled per second in the last `window` seconds
+        now = self.clock()
+        with self.lock:
+            while self.done and now - self.done[0][0] > window:
+                self.done.popleft()
+            return sum(n for _, n in self.done) / window
+
+    def stats(self):
+        rate = self.rate()
+        with self.lock:
+            return {
+                "queue": self.queue.qsize(),
+                "in_flight": self.in_flight,
+                "pending": len(self.pending),
+                "checked": self.counter["checked"],
+                "rounds": self.counter["rounds"],
+                "rate": round(rate, 2),
+            }
+
+
+class DueQueue:
+    # When subscriptions are due for a check, as a heap of
+    # `(due, subscription_id)` with due times in seconds since the epoch.
+    # Rescheduling a subscription leaves its old entry in the heap, entries
+    # not matching `self.due` are skipped when they get to the top.
+    # `wakeup` is set when a subscription becomes due before all the others.
+
+    def __init__(self, clock=time):
+        self.clock = clock
+        self.heap = []
+        self.due = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+    def schedule(self, subscription_id, at):
+        with self.lock:
+            first = not self.heap or at < self.heap[0][0]
+            self.due[subscription_id] = at
+            heapq.heappush(self.heap, (at, subscription_id))
+            # Don't let old entries pile up
+            if len(self.heap) > 2 * len(self.due) + 1024:
+                self.heap = [(due, i) for i, due in self.due.items()]
+                heapq.heapify(self.heap)
+        if first:
+            self.wakeup.set()
+
+    def remove(self, subscription_id):
+        with self.lock:
+            self.due.pop(subscription_id, None)
+
+    def pop(self, now=None):
+        # Remove and return the subscriptions that are due
+        now = self.clock() if now is None else now
+        subscription_ids = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                at, subscription_id = heapq.heappop(self.heap)
+                if self.due.get(subscription_id) == at:
+                    del self.due[subscription_id]
+                    subscription_ids.append(subscription_id)
+        return subscription_ids
+
+    def next_in(self):
+        # Seconds until the next subscription is due, `None` if there's none
+        with self.lock:
+            while self.heap and self.due.get(self.heap[0][1]) != self.heap[0][0]:
+                heapq.heappop(self.heap)
+            if not self.heap:
+                return None
+            return max(0, self.heap[0][0] - self.clock())
+
+    def __len__(self):
+        return len(self.due)
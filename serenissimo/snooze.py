@@ -1,5 +1,6 @@
 from .bot import bot, send_message, edit_message_text, edit_message_reply_markup
 from . import db
+from . import due
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
 
 
@@ -140,6 +141,7 @@ def callback_query(call):
                 snooze_to = None
                 with db.transaction() as t:
                     db.user.reset_snooze(t, user["id"])
+            due.reschedule_user(user["id"])
 
             interval = ""
             if snooze_from is not None and snooze_to is not None:
@@ -0,0 +1,110 @@
+import threading
+from contextlib import contextmanager
+from time import monotonic, sleep
+
+
+class Bucket:
+    # Token bucket for a single ULSS. `rate` is in requests per second, `None`
+    # means no limit.
+
+    def __init__(self, rate=None, burst=1, max_in_flight=None, clock=monotonic):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.clock = clock
+        self.tokens = self.burst
+        self.updated = clock()
+        self.lock = threading.Lock()
+        self.semaphore = (
+            threading.BoundedSemaphore(max_in_flight) if max_in_flight else None
+        )
+        self.requests = 0
+        self.in_flight = 0
+        self.wait_total = 0
+        self.wait_max = 0
+
+    def reserve(self):
+        # Take a token, and return how long to wait before using it
+        with self.lock:
+            if self.rate is None:
+                return 0
+            now = self.clock()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+
+class RateLimiter:
+    # Keep portal traffic polite: every ULSS gets its own token bucket and a
+    # cap on concurrent requests. `limits` overrides the defaults for specific
+    # ULSSes, e.g. `{1: {"rate": 2, "max_in_flight": 1}}`.
+
+    def __init__(
+        self,
+        rate=None,
+        burst=1,
+        max_in_flight=None,
+        limits=None,
+        clock=monotonic,
+        sleep=sleep,
+    ):
+        self.default = {"rate": rate, "burst": burst, "max_in_flight": max_in_flight}
+        self.limits = limits or {}
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def bucket(self, ulss):
+        with self.lock:
+            if ulss not in self.buckets:
+                config = dict(self.default, **self.limits.get(ulss, {}))
+                self.buckets[ulss] = Bucket(clock=self.clock, **config)
+            return self.buckets[ulss]
+
+    @contextmanager
+    def request(self, ulss):
+        bucket = self.bucket(ulss)
+        start = self.clock()
+        if bucket.semaphore:
+            bucket.semaphore.acquire()
+        try:
+            delay = bucket.reserve()
+            if delay > 0:
+                self.sleep(delay)
+            waited = self.clock() - start
+            with bucket.lock:
+                bucket.requests += 1
+                bucket.in_flight += 1
+                bucket.wait_total += waited
+                bucket.wait_max = max(bucket.wait_max, waited)
+            try:
+                yield waited
+            finally:
+                with bucket.lock:
+                    bucket.in_flight -= 1
+        finally:
+            if bucket.semaphore:
+                bucket.semaphore.release()
+
+    def stats(self):
+        # Queue wait times are in seconds
+        with self.lock:
+            buckets = dict(self.buckets)
+        stats = {}
+        for ulss, bucket in buckets.items():
+            with bucket.lock:
+                stats[ulss] = {
+                    "requests": bucket.requests,
+                    "in_flight": bucket.in_flight,
+                    "wait_total": bucket.wait_total,
+                    "wait_max": bucket.wait_max,
+                    "wait_avg": (
+                        bucket.wait_total / bucket.requests if bucket.requests else 0
+                    ),
+                }
+        return stats
@@ -0,0 +1,123 @@
+# Write the results of the checks in the background, many of them in the same
+# transaction, instead of opening a transaction (and waiting for the write
+# lock, and syncing to disk) for every row.
+#
+# `submit(fn, *args, **kwargs)` queues a call to `fn(t, *args, **kwargs)`,
+# with `t` the transaction. The queue is written when it has `max_rows`
+# writes, or `max_delay` seconds after the first one was queued, and on
+# `stop()`. Every write runs in a savepoint, so a failing one doesn't take the
+# others down.
+# `defer(fn)` calls `fn()` once everything queued so far is written.
+
+import logging
+import threading
+from collections import Counter
+
+from . import db
+
+log = logging.getLogger()
+
+
+class Writer:
+    def __init__(self, max_rows=100, max_delay=0.5, database="db.sqlite"):
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.database = database
+        self.writes = []
+        self.callbacks = []
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        # One flush at a time, so batches are written in order
+        self.flushing = threading.Lock()
+        self.stopping = False
+        self.thread = None
+        self.counter = Counter()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.stopping = False
+                self.thread = threading.Thread(
+                    target=self.run, name="writer", daemon=True
+                )
+                self.thread.start()
+        return self
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+            thread, self.thread = self.thread, None
+        if thread:
+            thread.join()
+        self.flush()
+
+    def submit(self, fn, *args, **kwargs):
+        self.start()
+        with self.condition:
+            self.writes.append((fn, args, kwargs))
+            if len(self.writes) >= self.max_rows:
+                self.condition.notify()
+
+    def defer(self, fn):
+        self.start()
+        with self.condition:
+            self.callbacks.append(fn)
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(
+                    lambda: self.writes or self.callbacks or self.stopping
+                )
+                if self.stopping:
+                    return
+                self.condition.wait_for(
+                    lambda: len(self.writes) >= self.max_rows or self.stopping,
+                    timeout=self.max_delay,
+                )
+            self.flush()
+
+    def flush(self):
+        with self.flushing:
+            with self.lock:
+                writes, self.writes = self.writes, []
+                callbacks, self.callbacks = self.callbacks, []
+            if writes:
+                try:
+                    self.write(writes)
+                except Exception:
+                    log.exception("Error writing %s rows, try again", len(writes))
+                    with self.lock:
+                        self.writes[:0] = writes
+                        self.callbacks[:0] = callbacks
+                    return 0
+            for fn in callbacks:
+                try:
+                    fn()
+                except Exception:
+                    log.exception("Error after writing")
+            return len(writes)
+
+    def write(self, writes):
+        errors = 0
+        with db.transaction(self.database) as t:
+            for fn, args, kwargs in writes:
+                t.execute("SAVEPOINT write")
+                try:
+                    fn(t, *args, **kwargs)
+                except Exception:
+                    log.exception("Error writing %s", getattr(fn, "__name__", fn))
+                    t.execute("ROLLBACK TO write")
+                    errors += 1
+                t.execute("RELEASE write")
+        with self.lock:
+            self.counter["batches"] += 1
+            self.counter["rows"] += len(writes)
+            self.counter["errors"] += errors
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counter)
+            stats["queue"] = len(self.writes)
+        return stats
@@ -16,6 +16,7 @@ setuptools.setup(
         "pyTelegramBotAPI>=3,<4",
         "python-codicefiscale==0.3.7",
         "python-dotenv==0.17.0",
+        "tzdata",
     ],
     long_description=long_description,
     long_description_content_type="text/markdown",
@@ -28,8 +29,8 @@ setuptools.setup(
         "License :: OSI Approved :: Mozilla Public License 2.0 (MPL 2.0)",
         "Operating System :: OS Independent",
     ],
-    package_data={"": ["*.sql"]},
+    package_data={"": ["*.sql", "fixtures/*.html"]},
     package_dir={"": "."},
     packages=setuptools.find_packages(where="."),
-    python_requires=">=3.6",
+    python_requires=">=3.9",
 )
@@ -1,6 +1,57 @@
+import threading
 import unittest
+from collections import Counter
+from time import sleep
+from unittest import mock
 
-from serenissimo import agent
+from requests.cookies import RequestsCookieJar
+
+from serenissimo import agent, scanner
+from serenissimo.breaker import CircuitBreaker
+from serenissimo.cache import TTLCache
+from serenissimo.fakeportal import FakePortal, load_fixture
+from serenissimo.pool import SessionPool
+from serenissimo.probe import Probes
+from serenissimo.scheduler import DueQueue, Scheduler, catch_up, phase
+from serenissimo.throttle import RateLimiter
+
+
+def setUpModule():
+    # Don't throttle requests to the fake sessions and portal, and don't
+    # let failures of one test open the circuit for the others
+    for name, value in [("limiter", RateLimiter()), ("breaker", CircuitBreaker())]:
+        patcher = mock.patch.object(agent, name, value)
+        patcher.start()
+        unittest.addModuleCleanup(patcher.stop)
+
+
+class FakeResponse:
+    def __init__(self, text, status_code=200):
+        self.text = text
+        self.status_code = status_code
+
+
+class FakeSession:
+    # Stand-in for `requests.Session`, `pages` maps URLs to HTML.
+    def __init__(self, pages):
+        self.pages = pages
+        self.cookies = RequestsCookieJar()
+        self.requests = []
+
+    def get(self, url, **kwargs):
+        self.requests.append(("GET", url))
+        self.cookies.set("PHPSESSID", "xyz")
+        return FakeResponse("")
+
+    def post(self, url, **kwargs):
+        self.requests.append(("POST", url))
+        page = self.pages[url]
+        if callable(page):
+            page = page(self)
+        return FakeResponse(page)
+
+    def close(self):
+        pass
 
 
 class TestAgent(unittest.TestCase):
@@ -80,6 +131,776 @@ class TestAgent(unittest.TestCase):
             ],
         )
 
+    def test_redirect_spaces(self):
+        for html, service in [
+            ("<script>act_step( 2,608)</script>", 608),
+            ("<script>act_step (2,608)</script>", 608),
+            ("<script>scegliserv (123)</script>", 123),
+        ]:
+            self.assertEqual(
+                agent.start(html, "X", 0),
+                ("eligible", agent.URL_SERVICE.format(0, service)),
+            )
+
+    def test_extract_locations(self):
+        html = """
+        <h2 class="centera">Selezionare una sede</h2>
+        <button class="btn btn-primary btn-full"  disabled type="button">Chioggia ASPO  [DISPONIBILITA ESAURITA] <br>Via Maestri del Lavoro 50, Chioggia (VE)</button> <button class="btn btn-primary btn-full"  onclick="act_step(3,5)" type="button">Dolo PALAZZETTO DELLO SPORT <br>Viale dello Sport 1, Dolo (VE)</button> <button class="btn btn-primary btn-full"  disabled type="button">Castelfranco Veneto &ndash; OSPEDALE <br>Via dei Carpani 16, Castelfranco Veneto (TV)</button>
+                <div style="text-align:center;padding:10px;">
+                <button class="btn btn-primary btn-back" onclick="act_step(1);" type="button"><i class="fas fa-undo"></i> Torna a identificazione</button>
+                </div>
+        <script>toggolaelem();</script>"""
+        available, unavailable = agent.extract_locations(html)
+        self.assertEqual(
+            available, ["Dolo PALAZZETTO DELLO SPORT Viale dello Sport 1, Dolo (VE)"]
+        )
+        self.assertEqual(
+            unavailable,
+            [
+                "Chioggia ASPO  [DISPONIBILITA ESAURITA] Via Maestri del Lavoro 50, Chioggia (VE)",
+                "Castelfranco Veneto – OSPEDALE Via dei Carpani 16, Castelfranco Veneto (TV)",
+            ],
+        )
+
+    def test_start(self):
+        self.assertEqual(
+            agent.start("<script>scegliserv(178)</script>", "X", 0),
+            ("eligible", agent.URL_SERVICE.format(0, 178)),
+        )
+        self.assertEqual(
+            agent.start("""<script>act_step(2,608)</script> """, "X", 0),
+            ("eligible", agent.URL_SERVICE.format(0, 608)),
+        )
+
+    def test_start_rules(self):
+        not_eligible = """
+    <div class="alert alert-danger">
+        Attenzione non appartieni alle categorie che attualmente possono prenotare
+    </div>
+    <div class="centera"><button class="btn btn-primary btn-back" onclick="act_step(1);" type="button"><i class="fas fa-undo"></i> Torna indietro</button></div>"""
+        maybe_eligible = """
+    <div class="alert alert-danger">
+        Attenzione non appartieni alle categorie che attualmente possono prenotare
+        , se ritieni di rientrarci utilizza il pulsante sottostante per accedere al processo di autocertificazione.
+        <a class="btn btn-danger" href="javascript:sceglicorte()";>Autocertificati</a>
+    </div>
+    <div class="centera"><button class="btn btn-primary btn-back" onclick="act_step(1);" type="button"><i class="fas fa-undo"></i> Torna indietro</button></div>"""
+        already_booked = """
+    <div class="alert alert-danger">
+        Per il codice fiscale inserito &egrave; gi&agrave; registrata una prenotazione.
+    </div>"""
+
+        hits = agent.rule_hits.copy()
+        self.assertEqual(agent.start(not_eligible, "X", 0), ("not_eligible", None))
+        self.assertEqual(
+            agent.start(maybe_eligible, "X", 0),
+            ("maybe_eligible", agent.URL_COHORT_CHOOSE.format(0)),
+        )
+        self.assertEqual(agent.start(already_booked, "X", 0), ("already_booked", None))
+        with self.assertRaises(agent.ApplicationException):
+            agent.start(agent.MESSAGE_APPLICATION_ERROR, "X", 0)
+        with self.assertRaises(agent.UnknownPayload):
+            agent.start("<h1>Manutenzione</h1>", "X", 0)
+
+        hits = agent.rule_hits - hits
+        self.assertEqual(
+            hits,
+            {
+                "not_eligible": 1,
+                "maybe_eligible": 1,
+                "already_booked": 1,
+                "application_error": 1,
+                "unknown": 1,
+            },
+        )
+
+    def test_same_payload(self):
+        scanner.clear()
+        reused = scanner.reused.copy()
+
+        # Copies of the payloads, like the ones we get from the next check
+        first = agent.extract_locations(LOCATIONS)
+        first[0].append("Altrove")
+        self.assertEqual(
+            agent.extract_locations("".join(list(LOCATIONS))),
+            (["Dolo PALAZZETTO"], ["Chioggia ASPO"]),
+        )
+        self.assertEqual(
+            agent.extract_urls(COHORTS, 0),
+            agent.extract_urls("".join(list(COHORTS)), 0),
+        )
+        for _ in range(2):
+            self.assertEqual(
+                agent.start(NOT_REGISTERED, "X", 0), ("not_registered", None)
+            )
+
+        # Classifying is cheaper than caching
+        self.assertEqual(scanner.reused - reused, {"locations": 1, "urls": 1})
+        self.assertEqual(scanner.stats()["pages"]["size"], 2)
+
+    def test_same_payload_set_root(self):
+        # URLs follow the root even if the payload was seen before
+        scanner.clear()
+        root = agent.URL_ROOT
+        first = agent.extract_urls(COHORTS, 0)
+        agent.set_root("http://localhost:8000")
+        self.addCleanup(agent.set_root, root)
+        self.assertEqual(
+            agent.extract_urls(COHORTS, 0),
+            [
+                [url.replace(root, "http://localhost:8000"), label]
+                for url, label in first
+            ],
+        )
+
+
+class TestCheckMany(unittest.TestCase):
+    def test_check_many(self):
+        def check(ulss, fiscal_code, health_insurance_number):
+            if fiscal_code == "FAIL":
+                raise agent.HTTPException()
+            return "eligible", ["Sede {}".format(ulss)], []
+
+        subscriptions = [
+            {
+                "subscription_id": i,
+                "ulss_id": i,
+                "fiscal_code": "FAIL" if i == 3 else "XXXXXXXXXXXXXXXX",
+                "health_insurance_number": "123456",
+            }
+            for i in range(1, 10)
+        ]
+
+        with mock.patch.object(agent, "check", check):
+            results = list(agent.check_many(subscriptions, max_concurrency=2))
+
+        self.assertEqual(len(results), 9)
+        by_id = {r[0]: r[1:] for r in results}
+        self.assertEqual(by_id[1], ("eligible", ["Sede 1"], []))
+        state, available, unavailable = by_id[3]
+        self.assertIsInstance(state, agent.HTTPException)
+        self.assertIsNone(available)
+        self.assertIsNone(unavailable)
+
+
+NOT_REGISTERED = """<div class="alert alert-danger">Il codice fiscale inserito non risulta tra quelli registrati presso questa ULSS.</div>"""
+
+
+class TestSessionPool(unittest.TestCase):
+    def setUp(self):
+        self.sessions = []
+        self.pages = {agent.URL_CHECK.format(0): NOT_REGISTERED}
+
+        def factory():
+            session = FakeSession(self.pages)
+            self.sessions.append(session)
+            return session
+
+        self.pool = SessionPool(size=1, factory=factory)
+        patcher = mock.patch.object(agent, "sessions", self.pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reuse_session(self):
+        self.assertEqual(agent.check(0, "X", "1")[0], "not_registered")
+        self.assertEqual(agent.check(0, "X", "1")[0], "not_registered")
+
+        self.assertEqual(len(self.sessions), 1)
+        self.assertEqual(
+            self.sessions[0].requests,
+            [
+                ("GET", agent.URL_ULSS.format(0)),
+                ("POST", agent.URL_CHECK.format(0)),
+                ("POST", agent.URL_CHECK.format(0)),
+            ],
+        )
+        stats = self.pool.stats()
+        self.assertEqual(stats["created"], 1)
+        self.assertEqual(stats["reused"], 1)
+        self.assertEqual(stats["idle"], {0: 1})
+
+    def test_refresh_rejected_cookie(self):
+        agent.check(0, "X", "1")
+        responses = [agent.MESSAGE_APPLICATION_ERROR, NOT_REGISTERED]
+        self.pages[agent.URL_CHECK.format(0)] = lambda session: responses.pop(0)
+
+        self.assertEqual(agent.check(0, "X", "1")[0], "not_registered")
+        self.assertEqual(self.pool.stats()["refreshed"], 1)
+        self.assertEqual(
+            [method for method, url in self.sessions[0].requests],
+            ["GET", "POST", "POST", "GET", "POST"],
+        )
+
+
+COHORTS = """
+<button class="btn btn-primary btn-full" onclick="inviacf(152)" type="button">Vulnerabili</button>
+<button class="btn btn-primary btn-full" onclick="inviacf(154)" type="button">Over 80</button>
+<button class="btn btn-primary btn-back" onclick="act_step(1);" type="button">Torna a identificazione</button>
+"""
+
+SERVICES = """
+<button class="btn btn-primary btn-full" onclick="act_step(2,101)" type="button">Nati prima del 1951</button>
+<button class="btn btn-primary btn-full" onclick="act_step(2,614)" type="button">Disabili</button>
+<button class="btn btn-primary btn-back" onclick="sceglicorte()" type="button">Torna a scelta categoria</button>
+"""
+
+REDIRECT = """<script>act_step(2,608)</script> """
+
+LOCATIONS = """
+<button class="btn btn-primary btn-full" disabled type="button">Chioggia ASPO</button>
+<button class="btn btn-primary btn-full" onclick="act_step(3,5)" type="button">Dolo PALAZZETTO</button>
+<button class="btn btn-primary btn-back" onclick="act_step(1);" type="button">Torna indietro</button>
+"""
+
+TREE = {
+    agent.URL_COHORT_CHOOSE.format(0): COHORTS,
+    agent.URL_COHORT_SELECT.format(0, 152): SERVICES,
+    agent.URL_COHORT_SELECT.format(0, 154): REDIRECT,
+    agent.URL_SERVICE.format(0, 101): LOCATIONS,
+    agent.URL_SERVICE.format(0, 614): LOCATIONS,
+    agent.URL_SERVICE.format(0, 608): LOCATIONS,
+}
+
+
+class TestLocations(unittest.TestCase):
+    def test_locations(self):
+        expected = (
+            {
+                "Vulnerabili": {
+                    "Nati prima del 1951": ["Dolo PALAZZETTO"],
+                    "Disabili": ["Dolo PALAZZETTO"],
+                },
+                "Over 80": ["Dolo PALAZZETTO"],
+            },
+            {
+                "Vulnerabili": {
+                    "Nati prima del 1951": ["Chioggia ASPO"],
+                    "Disabili": ["Chioggia ASPO"],
+                },
+                "Over 80": ["Chioggia ASPO"],
+            },
+        )
+        for max_fanout in [1, 4]:
+            session = FakeSession(TREE)
+            result = agent.locations(
+                session,
+                agent.URL_COHORT_CHOOSE.format(0),
+                0,
+                max_fanout=max_fanout,
+            )
+            self.assertEqual(result, expected)
+            self.assertEqual(len(session.requests), 6)
+
+    def test_locations_failure(self):
+        # A failed page doesn't leave requests running on the session
+        started = threading.Event()
+        done = []
+
+        def fail(session):
+            started.wait(1)
+            raise ValueError()
+
+        def slow(session):
+            started.set()
+            sleep(0.1)
+            done.append(True)
+            return REDIRECT
+
+        pages = dict(TREE)
+        pages[agent.URL_COHORT_SELECT.format(0, 152)] = fail
+        pages[agent.URL_COHORT_SELECT.format(0, 154)] = slow
+        with self.assertRaises(ValueError):
+            agent.locations(FakeSession(pages), agent.URL_COHORT_CHOOSE.format(0), 0)
+        self.assertEqual(done, [True])
+
+    def test_locations_max_depth(self):
+        session = FakeSession(TREE)
+        available, unavailable = agent.locations(
+            session, agent.URL_COHORT_CHOOSE.format(0), 0, max_depth=2
+        )
+        self.assertEqual(available, {})
+        self.assertEqual(unavailable, {})
+        self.assertEqual(len(session.requests), 3)
+
+    @mock.patch.object(agent, "paths", TTLCache())
+    def test_known_path(self):
+        pages = dict(TREE)
+        pages[agent.URL_CHECK.format(0)] = load_fixture("maybe_eligible")
+        session = FakeSession(pages)
+        hits = agent.path_hits.copy()
+
+        def check():
+            session.requests.clear()
+            return agent._check_with_session(session, 0, "X", "000000")
+
+        expected = check()
+        self.assertEqual(len(session.requests), 8)
+
+        # Straight to the location pages
+        self.assertEqual(check(), expected)
+        self.assertEqual(len(session.requests), 4)
+
+        # The portal doesn't let us skip steps anymore, walk the tree again
+        def location_page(session):
+            walked = ("POST", agent.URL_COHORT_CHOOSE.format(0)) in session.requests
+            return LOCATIONS if walked else agent.MESSAGE_APPLICATION_ERROR
+
+        for service in [101, 614, 608]:
+            pages[agent.URL_SERVICE.format(0, service)] = location_page
+        self.assertEqual(check(), expected)
+        self.assertEqual(len(session.requests), 10)
+
+        self.assertEqual(agent.path_hits - hits, {"miss": 1, "hit": 1, "stale": 1})
+
+    @mock.patch.object(agent, "paths", TTLCache())
+    def test_known_path_empty_locations(self):
+        empty = """<button class="btn btn-primary btn-back" onclick="act_step(1);" type="button">Torna indietro</button>"""
+        pages = dict(TREE)
+        pages[agent.URL_CHECK.format(0)] = load_fixture("maybe_eligible")
+        pages[agent.URL_SERVICE.format(0, 614)] = empty
+        session = FakeSession(pages)
+        hits = agent.path_hits.copy()
+
+        def check():
+            session.requests.clear()
+            return agent._check_with_session(session, 0, "X", "000000")
+
+        # A location page without locations is still a location page
+        expected = check()
+        self.assertEqual(check(), expected)
+        self.assertEqual(len(session.requests), 4)
+
+        # Nothing anywhere, not worth remembering: walk the whole tree (with
+        # the cookie we already have) every time
+        for service in [101, 608]:
+            pages[agent.URL_SERVICE.format(0, service)] = empty
+        agent.paths.clear()
+        for _ in range(2):
+            self.assertEqual(check(), ("maybe_eligible", {}, {}))
+            self.assertEqual(len(session.requests), 7)
+
+        self.assertEqual(agent.path_hits - hits, {"miss": 3, "hit": 1})
+
+
+class TestLocationCache(unittest.TestCase):
+    def test_location_cache(self):
+        cache = TTLCache(ttl=60)
+        with mock.patch.object(agent, "location_cache", cache):
+            first = FakeSession(TREE)
+            agent.locations(first, agent.URL_COHORT_CHOOSE.format(0), 0)
+            second = FakeSession(TREE)
+            result = agent.locations(second, agent.URL_COHORT_CHOOSE.format(0), 0)
+
+        self.assertEqual(result[0]["Over 80"], ["Dolo PALAZZETTO"])
+        self.assertEqual(len(first.requests), 6)
+        # Only the cohort pages are fetched again
+        self.assertEqual(len(second.requests), 3)
+        self.assertEqual(cache.stats(), {"hits": 3, "misses": 3, "size": 3})
+
+    def test_ttl_and_eviction(self):
+        now = [0]
+        cache = TTLCache(ttl=10, maxsize=2, clock=lambda: now[0])
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        # "b" is the least recently used
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        now[0] = 10
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(
+            cache.stats(),
+            {"hits": 1, "misses": 2, "expired": 1, "evicted": 1, "size": 1},
+        )
+
+
+class TestFakePortal(unittest.TestCase):
+    def setUp(self):
+        self.portal = FakePortal(
+            behavior={
+                1: {"start": "eligible"},
+                2: {"start": "not_registered"},
+                3: {"fiscal_codes": {"BOOKED": "already_booked"}},
+            }
+        ).start()
+        self.addCleanup(self.portal.stop)
+        root = agent.URL_ROOT
+        agent.set_root(self.portal.url)
+        self.addCleanup(agent.set_root, root)
+        patcher = mock.patch.object(agent, "sessions", SessionPool())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_check(self):
+        state, available, unavailable = agent.check(1, "X", "123456")
+        self.assertEqual(state, "eligible")
+        self.assertEqual(
+            available, ["Dolo PALAZZETTO DELLO SPORT Viale dello Sport 1, Dolo (VE)"]
+        )
+        self.assertEqual(len(unavailable), 4)
+
+        self.assertEqual(agent.check(2, "X", "123456"), ("not_registered", None, None))
+        self.assertEqual(
+            agent.check(3, "BOOKED", "123456"), ("already_booked", None, None)
+        )
+
+        state, available, unavailable = agent.check(3, "X", "123456")
+        self.assertEqual(state, "maybe_eligible")
+        self.assertEqual(
+            sorted(available.keys()),
+            [
+                "Oncologici",
+                "Over 80",
+                "Persone con disabilità grave (L. 104 art. 3 c.3)",
+                "Vulnerabili",
+            ],
+        )
+
+    def test_expired_session(self):
+        agent.check(2, "X", "123456")
+        self.portal.expire_sessions()
+        self.assertEqual(agent.check(2, "X", "123456")[0], "not_registered")
+        self.assertEqual(self.portal.stats()["rejected"], 1)
+        self.assertEqual(self.portal.stats()["home"], 2)
+
+    def test_http_error(self):
+        self.portal.default["error_rate"] = 1
+        with self.assertRaises(agent.HTTPException):
+            agent.check(1, "X", "123456")
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_token_bucket(self):
+        now = [0]
+
+        def sleep(seconds):
+            now[0] += seconds
+
+        limiter = RateLimiter(
+            rate=2, limits={1: {"rate": None}}, clock=lambda: now[0], sleep=sleep
+        )
+        for _ in range(3):
+            with limiter.request(0):
+                pass
+            with limiter.request(1):
+                pass
+
+        self.assertEqual(now[0], 1)
+        stats = limiter.stats()
+        self.assertEqual(stats[0]["requests"], 3)
+        self.assertEqual(stats[0]["wait_total"], 1)
+        self.assertEqual(stats[0]["wait_max"], 0.5)
+        self.assertEqual(stats[1]["wait_total"], 0)
+
+    def test_max_in_flight(self):
+        limiter = RateLimiter(max_in_flight=1)
+        with limiter.request(0):
+            self.assertEqual(limiter.stats()[0]["in_flight"], 1)
+            self.assertFalse(limiter.bucket(0).semaphore.acquire(blocking=False))
+        self.assertEqual(limiter.stats()[0]["in_flight"], 0)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_open_and_recover(self):
+        now = [0]
+        breaker = CircuitBreaker(min_calls=2, cooldown=60, clock=lambda: now[0])
+        calls = []
+
+        def _check(ulss, fiscal_code, health_insurance_number):
+            calls.append(ulss)
+            if fiscal_code == "DOWN":
+                raise agent.HTTPException()
+            return "not_registered", None, None
+
+        with mock.patch.object(agent, "breaker", breaker), mock.patch.object(
+            agent, "_check", _check
+        ):
+            for _ in range(2):
+                with self.assertRaises(agent.HTTPException):
+                    agent.check(1, "DOWN", "1")
+            self.assertEqual(breaker.state(1), "open")
+
+            # Other ULSSes are not affected
+            agent.check(2, "X", "1")
+            with self.assertRaises(agent.CircuitOpen):
+                agent.check(1, "X", "1")
+            self.assertEqual(calls, [1, 1, 2])
+
+            # After the cooldown a probe goes through and closes the circuit
+            now[0] = 60
+            self.assertEqual(agent.check(1, "X", "1")[0], "not_registered")
+            self.assertEqual(breaker.state(1), "closed")
+
+        stats = breaker.stats()
+        self.assertEqual(stats["opened"], 1)
+        self.assertEqual(stats["probes"], 1)
+        self.assertEqual(stats["rejected"], 1)
+
+    def test_half_open_single_probe(self):
+        now = [0]
+        breaker = CircuitBreaker(min_calls=1, cooldown=10, clock=lambda: now[0])
+        breaker.failure(1)
+        now[0] = 10
+        self.assertTrue(breaker.allow(1))
+        self.assertFalse(breaker.allow(1))
+        breaker.failure(1)
+        self.assertEqual(breaker.state(1), "open")
+
+    def test_stale_outcomes(self):
+        now = [0]
+        breaker = CircuitBreaker(min_calls=1, cooldown=10, clock=lambda: now[0])
+        # Let through before the circuit opened, done after the cooldown
+        token = breaker.allow(1)
+        breaker.failure(1)
+        now[0] = 10
+        probe = breaker.allow(1)
+        breaker.success(1, token)
+        self.assertEqual(breaker.state(1), "half_open")
+        self.assertFalse(breaker.allow(1))
+        breaker.success(1, probe)
+        self.assertEqual(breaker.state(1), "closed")
+        self.assertEqual(breaker.stats()["stale"], 1)
+
+    def test_deadline_exceeded(self):
+        now = [0]
+        breaker = CircuitBreaker(min_calls=1, cooldown=10, clock=lambda: now[0])
+
+        def _check(ulss, fiscal_code, health_insurance_number):
+            raise agent.DeadlineExceeded()
+
+        with mock.patch.object(agent, "breaker", breaker), mock.patch.object(
+            agent, "_check", _check
+        ):
+            for _ in range(3):
+                with self.assertRaises(agent.DeadlineExceeded):
+                    agent.check(1, "X", "1")
+            self.assertEqual(breaker.state(1), "closed")
+
+            # A probe running out of time lets the next one through
+            breaker.failure(1)
+            now[0] = 10
+            with self.assertRaises(agent.DeadlineExceeded):
+                agent.check(1, "X", "1")
+            self.assertEqual(breaker.state(1), "half_open")
+            self.assertTrue(breaker.allow(1))
+
+
+class TestTimeouts(unittest.TestCase):
+    def test_retry_idempotent_requests(self):
+        responses = [FakeResponse("", 500), FakeResponse("", 502)]
+
+        class FlakySession(FakeSession):
+            def post(self, url, **kwargs):
+                self.requests.append(("POST", url, kwargs["timeout"]))
+                if responses:
+                    return responses.pop(0)
+                return FakeResponse(self.pages[url])
+
+        session = FlakySession(TREE)
+        url = agent.URL_SERVICE.format(0, 608)
+        with mock.patch.object(agent, "sleep") as sleep:
+            self.assertEqual(agent.fetch(session, 0, url), LOCATIONS)
+        self.assertEqual(len(session.requests), 3)
+        self.assertEqual(session.requests[0][2], agent.TIMEOUT)
+        # Exponential backoff with jitter
+        (first,), (second,) = [call.args for call in sleep.call_args_list]
+        self.assertTrue(0.25 <= first <= 0.75)
+        self.assertTrue(0.5 <= second <= 1.5)
+
+        responses.extend([FakeResponse("", 500)] * 3)
+        with mock.patch.object(agent, "sleep"):
+            with self.assertRaises(agent.HTTPException):
+                agent.fetch(session, 0, url)
+
+    def test_deadline(self):
+        now = [0]
+
+        class SlowSession(FakeSession):
+            def post(self, url, **kwargs):
+                now[0] += 10
+                return super().post(url, **kwargs)
+
+        session = SlowSession(TREE)
+        deadline = agent.Deadline(15, clock=lambda: now[0])
+        with self.assertRaises(agent.DeadlineExceeded):
+            agent.locations(
+                session,
+                agent.URL_COHORT_CHOOSE.format(0),
+                0,
+                max_fanout=1,
+                deadline=deadline,
+            )
+        # The second cohort page is never requested
+        self.assertEqual(len(session.requests), 2)
+        self.assertEqual(deadline.remaining(), -5)
+
+
+class TestProbes(unittest.TestCase):
+    def subscription(self, subscription_id, fiscal_code, locations="[]"):
+        return {
+            "subscription_id": subscription_id,
+            "ulss_id": 1,
+            "status_id": "maybe_eligible",
+            "fiscal_code": fiscal_code,
+            "health_insurance_number": "000000",
+            "locations": locations,
+        }
+
+    @mock.patch.object(agent, "paths", TTLCache())
+    def test_probe_then_fan_out(self):
+        path = (agent.URL_COHORT_CHOOSE.format(1), [((agent.URL_SERVICE, ""),)])
+        for fiscal_code in "ABC":
+            agent.paths.set((1, fiscal_code, "000000"), path)
+
+        now = [0]
+        probes = Probes(max_age=600, clock=lambda: now[0])
+        portal = {"locations": '["Dolo"]'}
+        checked, skipped = [], []
+
+        def check(s):
+            checked.append(s["subscription_id"])
+            return portal["locations"]
+
+        def run(*subscriptions):
+            checked.clear()
+            skipped.clear()
+            probes.run(subscriptions, check, lambda s: skipped.append(s))
+
+        dolo = '["Dolo"]'
+        # First round, nothing to compare with: check everyone
+        run(
+            self.subscription(1, "A", dolo),
+            self.subscription(2, "B", dolo),
+            self.subscription(3, "C", "[]"),
+            self.subscription(4, "D", dolo),
+        )
+        self.assertEqual(checked, [4, 1, 2, 3])
+
+        # Same locations, only the probe and the subscription that is behind
+        run(
+            self.subscription(1, "A", dolo),
+            self.subscription(2, "B", dolo),
+            self.subscription(3, "C", "[]"),
+        )
+        self.assertEqual(checked, [1, 3])
+        self.assertEqual([s["subscription_id"] for s in skipped], [2])
+
+        # Locations changed
+        portal["locations"] = '["Chioggia"]'
+        run(self.subscription(1, "A", dolo), self.subscription(2, "B", dolo))
+        self.assertEqual(checked, [1, 2])
+
+        # Too long since the last fan out
+        now[0] = 600
+        run(
+            self.subscription(1, "A", '["Chioggia"]'),
+            self.subscription(2, "B", '["Chioggia"]'),
+        )
+        self.assertEqual(checked, [1, 2])
+
+        self.assertEqual(
+            probes.stats(),
+            {"single": 1, "probes": 4, "checked": 5, "skipped": 1, "groups": 1},
+        )
+
+
+class TestScheduler(unittest.TestCase):
+    def test_scheduler(self):
+        now = [1000]
+        due = DueQueue(clock=lambda: now[0])
+        for i in range(10):
+            due.schedule(i, 1000 + i % 2)
+        handled = []
+        lock = threading.Lock()
+
+        def select():
+            return [{"subscription_id": i} for i in due.pop()]
+
+        def handle(job):
+            sleep(0.01)
+            with lock:
+                handled.extend(s["subscription_id"] for s in job)
+            # The check of subscription 0 fails, try again in a minute
+            for s in job:
+                if s["subscription_id"] == 0:
+                    due.schedule(0, now[0] + 60)
+
+        scheduler = Scheduler(
+            select, handle, workers=3, until=due.next_in, wakeup=due.wakeup
+        ).start()
+        try:
+            for _ in range(200):
+                if scheduler.stats()["checked"] == 5:
+                    break
+                sleep(0.01)
+            # Time flies, the other subscriptions are due
+            now[0] = 1001
+            due.wakeup.set()
+            for _ in range(200):
+                if scheduler.stats()["checked"] == 10:
+                    break
+                sleep(0.01)
+        finally:
+            scheduler.stop()
+
+        self.assertEqual(sorted(handled), list(range(10)))
+        self.assertEqual(len(due), 1)
+        self.assertEqual(due.next_in(), 59)
+        stats = scheduler.stats()
+        self.assertEqual(stats["checked"], 10)
+        self.assertEqual(stats["in_flight"], 0)
+        self.assertEqual(stats["pending"], 0)
+        self.assertGreater(stats["rate"], 0)
+
+    def test_pending(self):
+        # A batch bigger than the queue is pending as soon as it's selected
+        selected = threading.Event()
+        release = threading.Event()
+
+        def select():
+            if selected.is_set():
+                return []
+            selected.set()
+            return [{"subscription_id": i} for i in range(10)]
+
+        scheduler = Scheduler(select, lambda job: release.wait(1), workers=1)
+        scheduler.start()
+        try:
+            selected.wait(1)
+            for _ in range(100):
+                if scheduler.stats()["in_flight"] == 1:
+                    break
+                sleep(0.01)
+            self.assertEqual(sorted(scheduler.pending_ids()), list(range(10)))
+        finally:
+            release.set()
+            scheduler.stop()
+        self.assertEqual(scheduler.pending_ids(), [])
+
+    def test_catch_up(self):
+        # Due after the restart, untouched
+        self.assertEqual(catch_up(1, 1500, 1000, 900), 1500)
+        # A backlog of 900 subscriptions is spread over 15 minutes, at most a
+        # few of them due in the same second
+        at = [catch_up(i, 0, 1000, 900) for i in range(1, 901)]
+        self.assertTrue(all(1000 <= t < 1900 for t in at))
+        self.assertLessEqual(max(Counter(int(t) for t in at).values()), 3)
+        self.assertEqual(at[0], 1000 + phase(1) * 900)
+
+    def test_due_queue(self):
+        due = DueQueue(clock=lambda: 100)
+        self.assertIsNone(due.next_in())
+        due.schedule(1, 150)
+        due.schedule(2, 120)
+        due.schedule(3, 90)
+        # Rescheduling replaces the old due time
+        due.schedule(2, 200)
+        due.remove(3)
+        self.assertEqual(due.next_in(), 50)
+        self.assertEqual(due.pop(160), [1])
+        self.assertEqual(due.pop(300), [2])
+        self.assertEqual(len(due), 0)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,6 +1,13 @@
+import json
+import os
+import tempfile
+import threading
 import unittest
 import sqlite3
-from serenissimo import db
+from datetime import datetime
+from time import sleep
+from serenissimo import db, due, interval
+from serenissimo.writer import Writer
 
 FC1 = "XXXXXXXXXXXXXXX1"
 FC2 = "XXXXXXXXXXXXXXX2"
@@ -23,6 +30,31 @@ HN8 = "888888"
 HN9 = "999999"
 
 
+def offset(subscription_id, window):
+    # The stable offset of a subscription within `window`, as in the DB
+    return subscription_id * 2654435761 % 2**32 * window // 2**32
+
+
+def local_hour(now, hours):
+    # The hour of the day for the users, `hours` from `now`
+    return datetime.fromtimestamp(now + hours * 60 * 60, db.user.TIMEZONE).hour
+
+
+def epoch(*args):
+    # Seconds since the epoch of a date and time for the users
+    return int(datetime(*args, tzinfo=db.user.TIMEZONE).timestamp())
+
+
+def update_interval(c, status_id):
+    r = c.execute("SELECT update_interval FROM status WHERE id = ?", (status_id,))
+    return r.fetchone()["update_interval"]
+
+
+def in_phase(subscription_id, due, interval):
+    # The last time in the phase of the subscription not after `due`
+    return due - (due - offset(subscription_id, interval)) % interval
+
+
 class TestDB(unittest.TestCase):
     def setUp(self):
         self.c = db.connect(":memory:")
@@ -171,35 +203,23 @@ class TestDB(unittest.TestCase):
         one_hour_ago = now - 60 * 60
         six_hour_ago = now - 6 * 60 * 60
         one_day_ago = now - 24 * 60 * 60
-        # Manually adjust the timezone to Europe/Rome in the query.
-        # That's not the best approach but I really want to keep things simple for now.
+        # Checked less than an interval ago, in its phase, so not due yet
+        not_due = in_phase(4, now, update_interval(self.c, "not_eligible"))
+        # Alice snoozes from -1 to +1 hours from now, in Europe/Rome
         db.user.update(
             self.c,
             alice,
-            # The math here is a bit tricky. The DB is UTC so we manually
-            # adjust to +2 CEST. We calculate alice's snooze_from and snooze_to
-            # from there. I this case alice snoozes from -1, +1 from now.
-            snooze_from=self.c.execute(
-                "SELECT CAST(strftime('%H', datetime('now', '+1 hours')) AS INT) as h"
-            ).fetchone()["h"],
-            snooze_to=self.c.execute(
-                "SELECT CAST(strftime('%H', datetime('now', '+3 hours')) AS INT) as h"
-            ).fetchone()["h"],
+            snooze_from=local_hour(now, -1),
+            snooze_to=local_hour(now, 1),
         )
 
+        # Carol snoozes from -6 to -4 from now, so she should receive
+        # notifications.
         db.user.update(
             self.c,
             carol,
-            # Carol snoozes from -6 to -4 from now, so she should receive
-            # notifications.
-            # -6 from now is 2 - 6 = -4
-            # -4 from now is 2 - 4 = -2
-            snooze_from=self.c.execute(
-                "SELECT CAST(strftime('%H', datetime('now', '-4 hours')) AS INT) as h"
-            ).fetchone()["h"],
-            snooze_to=self.c.execute(
-                "SELECT CAST(strftime('%H', datetime('now', '-2 hours')) AS INT) as h"
-            ).fetchone()["h"],
+            snooze_from=local_hour(now, -6),
+            snooze_to=local_hour(now, -4),
         )
 
         insert = """
@@ -216,7 +236,7 @@ class TestDB(unittest.TestCase):
                 # Nope
                 [bob, 1, FC3, HN3, "eligible", now],
                 # Nope
-                [bob, 1, FC4, HN4, "not_eligible", one_hour_ago],
+                [bob, 1, FC4, HN4, "not_eligible", not_due],
                 # Yep
                 [bob, 1, FC5, HN5, "not_registered", one_day_ago],
                 # Yep
@@ -271,6 +291,8 @@ class TestDB(unittest.TestCase):
         one_hour_ago = now - 60 * 60
         six_hour_ago = now - 6 * 60 * 60
         one_day_ago = now - 24 * 60 * 60
+        # Checked less than an interval ago, in its phase, so not due yet
+        not_due = in_phase(4, now, update_interval(self.c, "not_eligible"))
 
         insert = """
             INSERT INTO subscription (user_id, ulss_id, fiscal_code, health_insurance_number, status_id, last_check)
@@ -286,7 +308,7 @@ class TestDB(unittest.TestCase):
                 # Nope
                 [bob, 1, FC3, HN3, "eligible", now],
                 # Nope
-                [bob, 1, FC4, HN4, "not_eligible", one_hour_ago],
+                [bob, 1, FC4, HN4, "not_eligible", not_due],
                 # Yep
                 [bob, 1, FC5, HN5, "not_registered", one_day_ago],
                 # Yep
@@ -352,6 +374,146 @@ class TestDB(unittest.TestCase):
             ],
         )
 
+    def test_select_next_check(self):
+        alice = db.user.insert(self.c, "1234")
+
+        insert = """
+            INSERT INTO subscription (user_id, ulss_id, fiscal_code, health_insurance_number, status_id, last_check)
+            VALUES (?, ?, ?, ?, ?, ?)"""
+
+        self.c.executemany(
+            insert,
+            [
+                [alice, 1, FC1, HN1, "unknown", 0],
+                [alice, 1, FC2, HN2, "eligible", 1000],
+                [alice, 1, FC3, None, "unknown", 0],
+                [alice, 1, FC4, HN4, "already_vaccinated", 0],
+            ],
+        )
+
+        self.assertEqual(
+            db.subscription.select_next_check(self.c).fetchall(),
+            [
+                {"subscription_id": 1, "next_check": in_phase(1, 60 * 60, 60 * 60)},
+                {"subscription_id": 2, "next_check": in_phase(2, 2800, 30 * 60)},
+            ],
+        )
+        self.assertEqual(
+            db.subscription.select_next_check(self.c, [2, 3]).fetchall(),
+            [{"subscription_id": 2, "next_check": in_phase(2, 2800, 30 * 60)}],
+        )
+        self.assertEqual(
+            [
+                s["subscription_id"]
+                for s in db.subscription.select_stale(self.c, [2, 4])
+            ],
+            [2],
+        )
+
+    def test_next_check_at(self):
+        alice = db.user.insert(self.c, "1234")
+        subscription_id = db.subscription.insert(
+            self.c, alice, ulss_id=1, fiscal_code=FC1, health_insurance_number=HN1
+        )
+
+        def next_check_at():
+            r = self.c.execute(
+                "SELECT next_check_at FROM subscription WHERE id = ?",
+                (subscription_id,),
+            )
+            return r.fetchone()["next_check_at"]
+
+        # Never checked, check in the first hour from the epoch
+        self.assertEqual(next_check_at(), offset(subscription_id, 60 * 60))
+
+        # Due before 02:30 CEST, in its phase
+        db.subscription.update(self.c, subscription_id, status_id="eligible")
+        self.assertEqual(next_check_at(), offset(subscription_id, 30 * 60))
+
+        # Snoozed from 1 to 3, so in the first 15 minutes after 03:00 CET
+        db.user.update(self.c, alice, snooze_from=1, snooze_to=3, now=0)
+        self.assertEqual(
+            next_check_at(), 2 * 60 * 60 + offset(subscription_id, 15 * 60)
+        )
+        db.user.reset_snooze(self.c, alice)
+        self.assertEqual(next_check_at(), offset(subscription_id, 30 * 60))
+
+        db.subscription.update(self.c, subscription_id, set_last_check=True)
+        now = self.c.execute(
+            "SELECT CAST(strftime('%s', 'now') AS INT) as now"
+        ).fetchone()["now"]
+        self.assertLessEqual(next_check_at(), now + 30 * 60)
+        self.assertGreater(next_check_at(), now - 1)
+        self.assertEqual(next_check_at() % (30 * 60), offset(subscription_id, 30 * 60))
+
+    def test_snooze_window(self):
+        window = db.user.snooze_window
+        self.assertIsNone(window(None, 8, 0))
+
+        # In the window, and before it
+        now = epoch(2026, 10, 18, 23)
+        self.assertEqual(
+            window(22, 8, now), (epoch(2026, 10, 18, 22), epoch(2026, 10, 19, 8))
+        )
+        self.assertEqual(
+            window(24, 6, now), (epoch(2026, 10, 19, 0), epoch(2026, 10, 19, 6))
+        )
+        # After the end, the window of the next night
+        now = epoch(2026, 10, 19, 9)
+        self.assertEqual(
+            window(22, 8, now), (epoch(2026, 10, 19, 22), epoch(2026, 10, 20, 8))
+        )
+
+        # The night DST ends is one hour longer, the one it starts one shorter
+        start, end = window(22, 8, epoch(2026, 10, 24, 23))
+        self.assertEqual(end - start, 11 * 60 * 60)
+        self.assertEqual(end, epoch(2026, 10, 25, 8))
+        start, end = window(22, 8, epoch(2026, 3, 28, 23))
+        self.assertEqual(end - start, 9 * 60 * 60)
+        self.assertEqual(end, epoch(2026, 3, 29, 8))
+
+    def test_roll_snooze(self):
+        alice = db.user.insert(self.c, "1234")
+        subscription_id = db.subscription.insert(
+            self.c, alice, ulss_id=1, fiscal_code=FC1, health_insurance_number=HN1
+        )
+
+        def next_check_at():
+            r = self.c.execute(
+                "SELECT next_check_at FROM subscription WHERE id = ?",
+                (subscription_id,),
+            )
+            return r.fetchone()["next_check_at"]
+
+        now = epoch(2026, 10, 18, 23)
+        db.user.update(self.c, alice, snooze_from=22, snooze_to=8, now=now)
+        user = db.user.by_id(self.c, alice)
+        self.assertEqual(user["snooze_start_at"], epoch(2026, 10, 18, 22))
+        self.assertEqual(user["snooze_end_at"], epoch(2026, 10, 19, 8))
+
+        # Due during the night, wake up in the first 15 minutes after it
+        self.c.execute(
+            "UPDATE subscription SET last_check = ? WHERE id = ?",
+            (now, subscription_id),
+        )
+        end = epoch(2026, 10, 19, 8)
+        self.assertEqual(next_check_at(), end + offset(subscription_id, 15 * 60))
+
+        # Nothing to roll until a while after the end
+        self.assertEqual(db.user.roll_snooze(self.c, end), 0)
+        self.assertEqual(
+            db.user.roll_snooze(self.c, end + db.user.SNOOZE_ROLL_DELAY), 1
+        )
+        user = db.user.by_id(self.c, alice)
+        self.assertEqual(user["snooze_start_at"], epoch(2026, 10, 19, 22))
+        self.assertEqual(user["snooze_end_at"], epoch(2026, 10, 20, 8))
+        self.assertLess(next_check_at(), end)
+
+        db.user.reset_snooze(self.c, alice)
+        user = db.user.by_id(self.c, alice)
+        self.assertIsNone(user["snooze_end_at"])
+        self.assertEqual(db.user.roll_snooze(self.c, end), 0)
+
     def test_log(self):
         db.log.insert(self.c, "vaccinated")
         db.log.insert(self.c, "vaccinated")
@@ -360,6 +522,282 @@ class TestDB(unittest.TestCase):
         l = r.fetchall()
         self.assertEqual(len(l), 3)
 
+    def test_negative_cache(self):
+        db.negative_cache.update(self.c, 1, FC1, HN1, "not_registered")
+        db.negative_cache.update(self.c, 1, FC2, HN2, "eligible")
+        self.assertEqual(db.negative_cache.get(self.c, 1, FC1, HN1), "not_registered")
+        self.assertIsNone(db.negative_cache.get(self.c, 2, FC1, HN1))
+        self.assertIsNone(db.negative_cache.get(self.c, 1, FC2, HN2))
+
+        # Fiscal codes are not stored in clear
+        r = self.c.execute("SELECT * FROM negative_cache")
+        self.assertNotIn(FC1, str(r.fetchall()))
+
+        # A state we can't trust replaces the one we knew
+        db.negative_cache.update(self.c, 1, FC1, HN1, "eligible")
+        self.assertIsNone(db.negative_cache.get(self.c, 1, FC1, HN1))
+
+        db.negative_cache.update(self.c, 1, FC1, HN1, "already_vaccinated")
+        self.c.execute("UPDATE negative_cache SET expires_at = expires_at - 31 * 86400")
+        self.assertIsNone(db.negative_cache.get(self.c, 1, FC1, HN1))
+        db.negative_cache.delete_expired(self.c)
+        r = self.c.execute("SELECT COUNT(*) as total FROM negative_cache")
+        self.assertEqual(r.fetchone()["total"], 0)
+
+    def test_lease(self):
+        alice = db.user.insert(self.c, "1234")
+        ids = [
+            db.subscription.insert(
+                self.c, alice, ulss_id=1, fiscal_code=fc, health_insurance_number=hn
+            )
+            for fc, hn in [(FC1, HN1), (FC2, HN2), (FC3, HN3)]
+        ]
+        now = 1000
+
+        def stale(now, limit=100):
+            r = db.lease.select_stale(self.c, now, limit)
+            return [s["subscription_id"] for s in r]
+
+        self.assertEqual(stale(now, 2), ids[:2])
+        self.assertEqual(
+            db.lease.claim(self.c, "a", ids[:2], now, now + 300), set(ids[:2])
+        )
+
+        # Leased subscriptions are not selected, nor claimed, by others
+        self.assertEqual(stale(now), ids[2:])
+        self.assertEqual(db.lease.claim(self.c, "b", ids, now, now + 300), {ids[2]})
+
+        # Renew, and take over the expired leases
+        self.assertEqual(db.lease.extend(self.c, "a", ids, now + 600), 2)
+        self.assertEqual(stale(now + 200), [])
+        self.assertEqual(stale(now + 600), ids)
+        self.assertEqual(
+            db.lease.claim(self.c, "b", ids, now + 600, now + 900), set(ids)
+        )
+        self.assertEqual(db.lease.extend(self.c, "a", ids, now + 900), 0)
+
+        db.lease.release(self.c, "b", ids[:1])
+        self.assertEqual(stale(now + 600), ids[:1])
+        db.lease.delete_expired(self.c, now + 900)
+        r = self.c.execute("SELECT COUNT(*) as total FROM lease")
+        self.assertEqual(r.fetchone()["total"], 0)
+
+    def test_check_interval(self):
+        alice = db.user.insert(self.c, "1234")
+        ids = [
+            db.subscription.insert(
+                self.c,
+                alice,
+                ulss_id=ulss_id,
+                fiscal_code=fc,
+                health_insurance_number=hn,
+            )
+            for ulss_id, fc, hn in [(1, FC1, HN1), (2, FC2, HN2)]
+        ]
+        self.c.execute("UPDATE subscription SET status_id = 'eligible', last_check = 0")
+
+        def next_check_at():
+            r = self.c.execute("SELECT next_check_at FROM subscription ORDER BY id")
+            return [row["next_check_at"] for row in r]
+
+        self.assertEqual(next_check_at(), [in_phase(i, 30 * 60, 30 * 60) for i in ids])
+
+        # Not enough observations, keep the interval of the state
+        s = db.subscription.by_id(self.c, ids[0])
+        s["last_check"] = 1000
+        self.assertIsNone(interval.observe(self.c, s, "eligible", {}, 1600))
+        self.assertEqual(next_check_at(), [in_phase(i, 30 * 60, 30 * 60) for i in ids])
+
+        # A location opens every hour and stays open for 40 minutes
+        locations = {"Servizio": ["Sede"]}
+        now = 1600
+        for i in range(48):
+            s["last_check"], now = now, now + 20 * 60
+            found = locations if i % 3 < 2 else {}
+            result = interval.observe(self.c, s, "eligible", found, now)
+            s["locations"] = json.dumps(found)
+        self.assertAlmostEqual(result, 15 * 60, delta=2 * 60)
+        self.assertEqual(
+            next_check_at(),
+            [in_phase(ids[0], result, result), in_phase(ids[1], 30 * 60, 30 * 60)],
+        )
+
+        # Nothing moves, back off up to the upper bound
+        for i in range(200):
+            s["last_check"], now = now, now + 60 * 60
+            result = interval.observe(self.c, s, "eligible", {}, now)
+        self.assertEqual(result, interval.BOUNDS["eligible"][1])
+
+        # Moving to a state we don't adapt is not a change
+        self.assertEqual(
+            interval.target(0, 86400, 0, 0, interval.BOUNDS["eligible"]), 2 * 60 * 60
+        )
+        s["last_check"] = now - 600
+        interval.observe(self.c, s, "already_booked", {}, now)
+        row = db.check_interval.get(self.c, 1, "eligible")
+        self.assertLess(row["changes"], 1)
+
+
+class FileDB(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.database = os.path.join(self.tmp.name, "db.sqlite")
+        with db.transaction(self.database) as t:
+            db.init(t)
+            db.init_data(t)
+
+    def tearDown(self):
+        db.close(self.database)
+        self.tmp.cleanup()
+
+
+class TestConnections(FileDB):
+    def test_pooled(self):
+        with db.connection(self.database) as c:
+            pass
+        with db.transaction(self.database) as t:
+            self.assertIs(t, c)
+            self.assertEqual(
+                t.execute("PRAGMA foreign_keys").fetchone(), {"foreign_keys": 1}
+            )
+
+        # A failed transaction leaves the connection usable
+        with self.assertRaises(sqlite3.IntegrityError):
+            with db.transaction(self.database) as t:
+                db.user.insert(t, "1234")
+                db.user.insert(t, "1234")
+        with db.transaction(self.database) as t:
+            db.user.insert(t, "1234")
+
+        # Every thread has its own connection
+        other = []
+        thread = threading.Thread(target=lambda: other.append(db.pooled(self.database)))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], c)
+
+        db.close(self.database)
+        with db.connection(self.database) as c2:
+            self.assertIsNot(c2, c)
+            self.assertIsNotNone(db.user.by_telegram_id(c2, "1234"))
+
+    def test_row_factory(self):
+        select = "SELECT id, telegram_id FROM user"
+        with db.transaction(self.database) as t:
+            db.user.insert(t, "1234")
+        with db.connection(self.database, row_factory=None) as c:
+            self.assertEqual(c.execute(select).fetchall(), [(1, "1234")])
+            with db.connection(self.database, row_factory=sqlite3.Row) as c:
+                row = c.execute(select).fetchone()
+                self.assertEqual((row["id"], row["telegram_id"]), (1, "1234"))
+            self.assertEqual(c.execute(select).fetchone(), (1, "1234"))
+        with db.connection(self.database) as c:
+            self.assertEqual(
+                c.execute(select).fetchone(), {"id": 1, "telegram_id": "1234"}
+            )
+
+    def test_nested(self):
+        with db.transaction(self.database) as t:
+            db.user.insert(t, "1")
+            # A failing transaction nested in another only rolls back itself
+            with self.assertRaises(sqlite3.IntegrityError):
+                with db.transaction(self.database) as nested:
+                    self.assertIs(nested, t)
+                    db.user.insert(nested, "2")
+                    db.user.insert(nested, "1")
+            with db.transaction(self.database, row_factory=sqlite3.Row) as nested:
+                db.user.insert(nested, "3")
+            self.assertEqual(t.execute("SELECT 1 AS x").fetchone(), {"x": 1})
+        with db.connection(self.database) as c:
+            users = c.execute("SELECT telegram_id FROM user ORDER BY id").fetchall()
+            self.assertEqual([u["telegram_id"] for u in users], ["1", "3"])
+            self.assertFalse(c.in_transaction)
+
+    def test_begin_fails(self):
+        # Someone else holds the write lock
+        other = db.connect(self.database)
+        other.execute("BEGIN IMMEDIATE")
+        with db.connection(self.database) as c:
+            c.execute("PRAGMA busy_timeout = 0")
+        with self.assertRaises(sqlite3.OperationalError):
+            with db.transaction(self.database, row_factory=None):
+                pass
+        other.rollback()
+        other.close()
+        c = db.pooled(self.database)
+        self.assertIs(c.row_factory, db.dict_factory)
+        self.assertFalse(c.in_transaction)
+
+
+class TestDue(FileDB):
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(setattr, due, "loaded", False)
+        self.addCleanup(setattr, due, "queue", due.queue)
+        due.queue = due.DueQueue()
+
+    def test_not_loaded(self):
+        with db.transaction(self.database) as t:
+            user_id = db.user.insert(t, "1")
+            subscription_id = db.subscription.insert(t, user_id, "1", "FC", "HN")
+        # Nothing would ever pop them
+        due.reschedule_user(user_id, database=self.database)
+        self.assertEqual(len(due.queue), 0)
+
+        self.assertEqual(due.load(self.database), 1)
+        due.queue.remove(subscription_id)
+        due.reschedule_user(user_id, database=self.database)
+        self.assertEqual(len(due.queue), 1)
+
+
+class TestWriter(FileDB):
+
+    def logs(self):
+        with db.connection(self.database) as c:
+            return [row["x"] for row in c.execute("SELECT x FROM log ORDER BY x")]
+
+    def test_writer(self):
+        writer = Writer(max_rows=3, max_delay=60, database=self.database)
+        written = []
+
+        def fail(t):
+            raise ValueError()
+
+        writer.submit(db.log.insert, "test", "a")
+        writer.submit(fail)
+        writer.defer(lambda: written.append(self.logs()))
+        self.assertEqual(self.logs(), [])
+
+        # A full batch is written right away, without the failing write
+        writer.submit(db.log.insert, "test", "b")
+        for _ in range(100):
+            if written:
+                break
+            sleep(0.01)
+        self.assertEqual(written, [["a", "b"]])
+
+        # What's left is written on stop
+        writer.submit(db.log.insert, "test", "c")
+        writer.stop()
+        self.assertEqual(self.logs(), ["a", "b", "c"])
+        self.assertEqual(
+            writer.stats(), {"batches": 2, "rows": 4, "errors": 1, "queue": 0}
+        )
+
+    def test_flush_in_order(self):
+        # Writing right away doesn't skip what's queued before
+        with db.transaction(self.database) as t:
+            user_id = db.user.insert(t, "1")
+            subscription_id = db.subscription.insert(t, user_id, "1", "FC", "HN")
+        writer = Writer(max_rows=100, max_delay=60, database=self.database)
+        writer.submit(db.subscription.update, subscription_id, status_id="not_eligible")
+        writer.submit(db.subscription.update, subscription_id, status_id="eligible")
+        self.assertEqual(writer.flush(), 2)
+        with db.connection(self.database) as c:
+            s = db.subscription.by_id(c, subscription_id)
+        self.assertEqual(s["status_id"], "eligible")
+        writer.stop()
+
 
 if __name__ == "__main__":
     unittest.main()